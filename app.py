@@ -1,12 +1,40 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g, Response, send_file, abort
+from flask import before_render_template, template_rendered
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from itsdangerous import BadSignature
 import sqlite3
-from collections import Counter
+import ast
 import re
+import json
+import math
+import click
 import os
 import time
 import random
+import queue
+import threading
+import heapq
+import base64
+import hashlib
+import secrets
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
+from itertools import islice
+from matching import create_index
+from notification_stream import NotificationBroker, StreamServer
+from sampling import shuffled_positions
+import photos
+from assets import AssetManifest
+from fragment_cache import FragmentCache
+from passwords import HasherBusy, PasswordHasher
+from write_queue import WriteQueue
+from shared_index import SharedOverlapIndex, TermSegment
+from maintenance import MaintenanceScheduler
+from metrics import COUNT_BUCKETS, SECONDS_BUCKETS, Histogram, InstrumentedConnection, RequestStats
 
 THIS_FOLDER = Path(__file__).parent.resolve()
 users_table = THIS_FOLDER / "users.db"
@@ -14,99 +42,1382 @@ users_table = THIS_FOLDER / "users.db"
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Longest side of the thumbnails shown on profile cards, and threads rendering them
+app.config['PHOTO_THUMB_SIZE'] = 320
+app.config['PHOTO_WORKERS'] = 2
+# Password hashes are computed on PASSWORD_WORKERS threads of their own. With PASSWORD_QUEUE_LIMIT
+# operations running or waiting, further sign-ins and registrations get a 503 instead of queueing;
+# keep it below the server's request threads so a login burst can't occupy all of them.
+# Stored hashes with another method are rehashed with this one on the user's next login.
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'
+app.config['PASSWORD_WORKERS'] = os.cpu_count() or 1
+app.config['PASSWORD_QUEUE_LIMIT'] = 4 * app.config['PASSWORD_WORKERS']
+app.config['PASSWORD_TIMEOUT'] = 5
+# Fingerprinted static URLs are cached this long; their URL changes whenever the file does
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+app.config['ASSET_CACHE_FOLDER'] = os.path.join(app.instance_path, 'static-cache')
+
+app.config['DATABASE'] = os.environ.get('RELATIKA_DATABASE', str(users_table))
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
+app.config['DB_SYNCHRONOUS'] = 'NORMAL'
+app.config['DB_CACHE_SIZE_KB'] = 16384
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['DB_LOCK_RETRIES'] = 5
+app.config['DB_LOCK_BACKOFF'] = 0.05
+# 'overlap' (word overlap), 'tfidf' / 'bm25' which need numpy and scipy,
+# or 'embedding' which needs numpy and keeps vectors in VECTOR_STORE_PATH
+app.config['MATCH_ENGINE'] = os.environ.get('RELATIKA_MATCH_ENGINE', 'overlap')
+app.config['VECTOR_STORE_PATH'] = app.config['DATABASE'] + '.vectors'
+app.config['VECTOR_DIM'] = 256
+# Keep each user's best N matches in the match_scores table and serve /matches from it
+# (None scores on every request instead, using MATCH_TOP_K)
+app.config['MATCH_LIST_SIZE'] = 200
+# With the 'overlap' engine, keep the tokenized about texts in shared memory mapped by every worker
+# process instead of in a copy per process. Each worker overlays the edits made since the segment
+# was built; past MATCH_SEGMENT_REBUILD of them, one worker builds and publishes a fresh segment.
+app.config['MATCH_SHARED_MEMORY'] = True
+app.config['MATCH_SEGMENT_REBUILD'] = 1000
+# Only rank the best N candidates instead of every user (None shows everyone)
+app.config['MATCH_TOP_K'] = None
+# Only score users within this many km of the current user, when both have coordinates
+app.config['MATCH_RADIUS_KM'] = None
+# Otherwise only score the N users nearest to the current user (None scores regardless of distance)
+app.config['MATCH_NEAREST'] = None
+# Candidate ids checked per query when drawing the next profile to browse
+app.config['BROWSE_BATCH_SIZE'] = 32
+# Profile cards per page of /api/matches and /api/saved, and the most a client may ask for
+app.config['API_PAGE_SIZE'] = 24
+app.config['API_MAX_PAGE_SIZE'] = 100
+# Contact messages per page of /admin/contact_messages
+app.config['ADMIN_PAGE_SIZE'] = 50
+# Users who may search contact messages, by id (RELATIKA_ADMIN_USER_IDS=1,2); nobody when unset
+app.config['ADMIN_USER_IDS'] = {int(user_id) for user_id in os.environ.get('RELATIKA_ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+# Requests slower than this are written to SLOW_REQUEST_LOG with every statement they ran (None disables the log)
+app.config['SLOW_REQUEST_MS'] = 500
+app.config['SLOW_REQUEST_LOG'] = os.environ.get('RELATIKA_SLOW_REQUEST_LOG')
+# Memory budget for rendered per-user navigation fragments
+app.config['FRAGMENT_CACHE_BYTES'] = 4 * 1024 * 1024
+# Serve /notifications/stream from an asyncio server on this port. The Flask app has no stream route
+# of its own, as each open tab would hold a worker thread; without a stream server pages poll instead.
+app.config['NOTIFICATION_STREAM_PORT'] = int(os.environ['RELATIKA_STREAM_PORT']) if os.environ.get('RELATIKA_STREAM_PORT') else None
+# Where browsers open the stream: /notifications/stream routed by a proxy to NOTIFICATION_STREAM_PORT,
+# or to `flask notification-stream` running on its own (set this then, as the port is not set)
+app.config['NOTIFICATION_STREAM_URL'] = '/notifications/stream' if app.config['NOTIFICATION_STREAM_PORT'] else None
+# Outbox rows kept for relaying events between processes
+app.config['NOTIFICATION_OUTBOX_KEEP'] = 10000
+# Housekeeping runs on a background thread in slices of at most MAINTENANCE_SLICE_SECONDS, with
+# MAINTENANCE_PAUSE_SECONDS between them. Every MAINTENANCE_CHECK_SECONDS it starts the jobs whose
+# interval (seconds, in MAINTENANCE_INTERVALS) has passed since their last run; None disables it.
+app.config['MAINTENANCE_CHECK_SECONDS'] = 60
+app.config['MAINTENANCE_SLICE_SECONDS'] = 0.05
+app.config['MAINTENANCE_PAUSE_SECONDS'] = 0.5
+app.config['MAINTENANCE_INTERVALS'] = {
+    'orphan_uploads': 24 * 3600,
+    'dangling_rows': 6 * 3600,
+    'analyze': 24 * 3600,
+    'incremental_vacuum': 3600,
+}
+# Upload files younger than this are never collected: their photos row may not be committed yet
+app.config['ORPHAN_UPLOAD_GRACE'] = 3600
+# Social actions (saves, requests and their answers) are written by one thread that commits whatever
+# queued up meanwhile together, at most WRITE_BATCH_SIZE writes per transaction
+app.config['WRITE_BATCH_SIZE'] = 64
+app.config['WRITE_TIMEOUT'] = 10
+
+connection_pool = queue.LifoQueue(maxsize=app.config['DB_POOL_SIZE'])
+
+def retry_on_locked(func):
+    # Exponential backoff with full jitter, so contending writers don't retry in lockstep
+    for attempt in range(app.config['DB_LOCK_RETRIES']):
+        try:
+            return func()
+        except sqlite3.OperationalError as e:
+            if 'database is locked' not in str(e):
+                raise e
+            time.sleep(random.uniform(0, app.config['DB_LOCK_BACKOFF'] * 2 ** attempt))
+    return func()
+
+def connect_db():
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000, check_same_thread=False,
+                           factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA busy_timeout = %d' % app.config['DB_BUSY_TIMEOUT_MS'])
+    # Lets maintenance return free pages to the file system. Only takes effect on a new database,
+    # before WAL mode writes its first page; existing ones are converted by `flask vacuum-db`.
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    retry_on_locked(lambda: conn.execute('PRAGMA journal_mode = WAL'))
+    conn.execute('PRAGMA synchronous = %s' % app.config['DB_SYNCHRONOUS'])
+    conn.execute('PRAGMA cache_size = %d' % -app.config['DB_CACHE_SIZE_KB'])
+    conn.execute('PRAGMA mmap_size = %d' % app.config['DB_MMAP_SIZE'])
+    return conn
 
 def get_db_connection():
-    retries = 5
-    while retries > 0:
+    # One pooled connection per request (or app context), returned to the pool on teardown
+    if 'db' not in g:
         try:
-            conn = sqlite3.connect(users_table, check_same_thread=False)
-            conn.row_factory = sqlite3.Row
-            return conn
-        except sqlite3.OperationalError as e:
-            if 'database is locked' in str(e):
-                time.sleep(1)
-                retries -= 1
+            g.db = connection_pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+        g.db.stats = g.get('request_stats')
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    conn.stats = None
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        connection_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# Notification count per user from scratch: incoming pending requests plus
+# answered outgoing requests that haven't been acknowledged yet
+NOTIFICATION_COUNTS_SQL = '''
+    SELECT user_id, SUM(count) AS count FROM (
+        SELECT requestee_id AS user_id, COUNT(*) AS count FROM photo_reveals WHERE status = 'pending' GROUP BY requestee_id
+        UNION ALL SELECT requestee_id, COUNT(*) FROM contact_shares WHERE status = 'pending' GROUP BY requestee_id
+        UNION ALL SELECT requester_id, COUNT(*) FROM photo_reveals WHERE status <> 'pending' AND message != 'Acknowledged' GROUP BY requester_id
+        UNION ALL SELECT requester_id, COUNT(*) FROM contact_shares WHERE status <> 'pending' AND message != 'Acknowledged' GROUP BY requester_id
+    ) WHERE user_id IS NOT NULL GROUP BY user_id
+'''
+
+def notification_counter_triggers(table):
+    # Keep notification_counters exact under every insert, update and delete on `table`
+    pending = "{row}.status = 'pending'"
+    answered = "{row}.status <> 'pending' AND {row}.message != 'Acknowledged'"
+    increment = '''INSERT INTO notification_counters (user_id, count) SELECT {row}.{column}, 1 WHERE {row}.{column} IS NOT NULL AND {condition}
+                ON CONFLICT (user_id) DO UPDATE SET count = count + 1;'''
+    decrement = '''UPDATE notification_counters SET count = count - 1 WHERE user_id = {row}.{column} AND {condition};'''
+
+    def apply(template, row):
+        return '\n                '.join([
+            template.format(row=row, column='requestee_id', condition=pending.format(row=row)),
+            template.format(row=row, column='requester_id', condition=answered.format(row=row)),
+        ])
+
+    return [
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_counters_insert AFTER INSERT ON {table}
+            BEGIN
+                {apply(increment, 'NEW')}
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_counters_update AFTER UPDATE OF requester_id, requestee_id, status, message ON {table}
+            BEGIN
+                {apply(decrement, 'OLD')}
+                {apply(increment, 'NEW')}
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_counters_delete AFTER DELETE ON {table}
+            BEGIN
+                {apply(decrement, 'OLD')}
+            END''',
+    ]
+
+def add_column(table, definition):
+    # SQLite has no ADD COLUMN IF NOT EXISTS; check the table first so the migration can re-run
+    def migrate(conn):
+        column = definition.split()[0]
+        if column not in [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]:
+            conn.execute('ALTER TABLE %s ADD COLUMN %s' % (table, definition))
+    return migrate
+
+def unique_request_pairs(table):
+    # Of duplicate requests keep the answered one, accepted before declined, then the newest
+    return [
+        f'''DELETE FROM {table} WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY requester_id, requestee_id
+                    ORDER BY CASE status WHEN 'accepted' THEN 0 WHEN 'declined' THEN 1 ELSE 2 END, id DESC
+                ) AS position FROM {table}
+            ) WHERE position > 1)''',
+        f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_pair ON {table} (requester_id, requestee_id)',
+    ]
+
+def full_text_index(table, column):
+    # FTS5 index reading its text from `table` (external content), kept in sync by triggers
+    index = f'{table}_fts'
+    insert = f'INSERT INTO {index} (rowid, {column}) VALUES (NEW.id, NEW.{column});'
+    delete = f"INSERT INTO {index} ({index}, rowid, {column}) VALUES ('delete', OLD.id, OLD.{column});"
+    return [
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({column}, content='{table}', content_rowid='id',
+            tokenize='porter unicode61 remove_diacritics 2')''',
+        f"INSERT INTO {index} ({index}) VALUES ('rebuild')",
+        f'''CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table}
+            BEGIN
+                {insert}
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {column} ON {table}
+            BEGIN
+                {delete}
+                {insert}
+            END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table}
+            BEGIN
+                {delete}
+            END''',
+    ]
+
+def fragment_version_triggers():
+    # Bump fragment_versions for every user whose navigation a write changes: their own profile,
+    # their saved profiles, and requests they sent or received (badge and saved count)
+    bump = '''INSERT INTO fragment_versions (user_id, version) SELECT {row}.{column}, 1 WHERE {row}.{column} IS NOT NULL
+                ON CONFLICT (user_id) DO UPDATE SET version = version + 1;'''
+    # Deleted users keep their stamp, so a reused id never matches the previous owner's fragment
+    watched = [('users', ['id'], ['UPDATE', 'DELETE']), ('saved_profiles', ['user_id'], ['INSERT', 'DELETE'])]
+    watched += [(table, ['requester_id', 'requestee_id'], ['INSERT', 'UPDATE', 'DELETE']) for table in ('photo_reveals', 'contact_shares')]
+    triggers = []
+    for table, columns, events in watched:
+        for event in events:
+            rows = ['OLD', 'NEW'] if event == 'UPDATE' and table != 'users' else ['OLD' if event == 'DELETE' else 'NEW']
+            body = '\n                '.join(bump.format(row=row, column=column) for row in rows for column in columns)
+            triggers.append(f'''CREATE TRIGGER IF NOT EXISTS {table}_fragment_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                {body}
+            END''')
+    return triggers
+
+# Genders offered at registration; looking_for is a comma-joined subset of them
+GENDERS = ('M', 'F', 'O')
+
+def accepted_genders_sql(row):
+    # (gender, user_id) for every gender `row` (a table, or NEW in a trigger) is looking for;
+    # no preference accepts them all
+    genders = ' UNION ALL '.join("SELECT '%s' AS gender" % gender for gender in GENDERS)
+    source = '' if row == 'NEW' else ', ' + row
+    return f'''SELECT genders.gender, {row}.id FROM ({genders}) AS genders{source}
+                WHERE COALESCE({row}.looking_for, '') = '' OR instr(',' || {row}.looking_for || ',', ',' || genders.gender || ',') > 0'''
+
+# Schema migrations, applied in order at startup. PRAGMA user_version records
+# how many have run; every statement (SQL, or a function taking the connection)
+# must be safe to re-run on a database that already has the change.
+MIGRATIONS = [
+    # 1: baseline schema
+    [
+        '''CREATE TABLE IF NOT EXISTS "users" (
+            "id" INTEGER, "username" TEXT NOT NULL UNIQUE, "password" TEXT NOT NULL, "about" TEXT, "name" TEXT,
+            "age" INTEGER, "gender" TEXT, "looking_for" TEXT, "location" TEXT, "latitude" REAL, "longitude" REAL,
+            "email" TEXT, "tel" TEXT, "instagram" TEXT, "telegram" TEXT,
+            PRIMARY KEY("id" AUTOINCREMENT))''',
+        '''CREATE TABLE IF NOT EXISTS "photos" (
+            "id" INTEGER, "user_id" INTEGER, "filename" TEXT,
+            PRIMARY KEY("id" AUTOINCREMENT))''',
+        '''CREATE TABLE IF NOT EXISTS "saved_profiles" (
+            "user_id" INTEGER, "profile_id" INTEGER,
+            PRIMARY KEY("user_id", "profile_id"))''',
+        '''CREATE TABLE IF NOT EXISTS "photo_reveals" (
+            "id" INTEGER, "requester_id" INTEGER, "requestee_id" INTEGER, "status" TEXT DEFAULT 'pending', "message" TEXT,
+            FOREIGN KEY("requestee_id") REFERENCES "users"("id"), FOREIGN KEY("requester_id") REFERENCES "users"("id"),
+            PRIMARY KEY("id" AUTOINCREMENT))''',
+        '''CREATE TABLE IF NOT EXISTS "contact_shares" (
+            "id" INTEGER, "requester_id" INTEGER, "requestee_id" INTEGER, "status" TEXT DEFAULT 'pending', "message" TEXT,
+            FOREIGN KEY("requestee_id") REFERENCES "users"("id"), FOREIGN KEY("requester_id") REFERENCES "users"("id"),
+            PRIMARY KEY("id" AUTOINCREMENT))''',
+        '''CREATE TABLE IF NOT EXISTS "contact_messages" (
+            "id" INTEGER, "name" TEXT, "email" TEXT, "message" TEXT,
+            PRIMARY KEY("id" AUTOINCREMENT))''',
+    ],
+    # 2: secondary indexes for the per-user lookups
+    [
+        'CREATE INDEX IF NOT EXISTS idx_photos_user_id ON photos (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_photo_reveals_requestee_status ON photo_reveals (requestee_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_photo_reveals_requester_message ON photo_reveals (requester_id, message)',
+        'CREATE INDEX IF NOT EXISTS idx_contact_shares_requestee_status ON contact_shares (requestee_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_contact_shares_requester_message ON contact_shares (requester_id, message)',
+        'CREATE INDEX IF NOT EXISTS idx_saved_profiles_profile_id ON saved_profiles (profile_id)',
+        'CREATE INDEX IF NOT EXISTS idx_contact_messages_email ON contact_messages (email)',
+    ],
+    # 3: R*Tree over users' coordinates, kept in sync by triggers
+    [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS user_locations USING rtree(id, min_lat, max_lat, min_lon, max_lon)',
+        '''INSERT OR REPLACE INTO user_locations
+            SELECT id, latitude, latitude, longitude, longitude FROM users
+            WHERE latitude BETWEEN -90 AND 90 AND longitude BETWEEN -180 AND 180''',
+        '''CREATE TRIGGER IF NOT EXISTS users_location_insert AFTER INSERT ON users
+            WHEN NEW.latitude BETWEEN -90 AND 90 AND NEW.longitude BETWEEN -180 AND 180
+            BEGIN
+                INSERT OR REPLACE INTO user_locations VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_location_update AFTER UPDATE OF latitude, longitude ON users
+            BEGIN
+                DELETE FROM user_locations WHERE id = OLD.id;
+                INSERT INTO user_locations SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+                    WHERE NEW.latitude BETWEEN -90 AND 90 AND NEW.longitude BETWEEN -180 AND 180;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_location_delete AFTER DELETE ON users
+            BEGIN
+                DELETE FROM user_locations WHERE id = OLD.id;
+            END''',
+    ],
+    # 4: per-user notification counters, maintained by triggers
+    [
+        'CREATE TABLE IF NOT EXISTS notification_counters (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)',
+        'DELETE FROM notification_counters',
+        'INSERT INTO notification_counters (user_id, count) ' + NOTIFICATION_COUNTS_SQL,
+        *notification_counter_triggers('photo_reveals'),
+        *notification_counter_triggers('contact_shares'),
+    ],
+    # 5: outbox of notification events, relayed to stream servers in other processes
+    [
+        '''CREATE TABLE IF NOT EXISTS notification_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT,
+            origin INTEGER
+        )''',
+    ],
+    # 6: content-addressed uploads with thumbnail variants
+    [
+        add_column('photos', 'content_hash TEXT'),
+        add_column('photos', 'thumb_filename TEXT'),
+        add_column('photos', 'thumb_webp_filename TEXT'),
+        'CREATE INDEX IF NOT EXISTS idx_photos_filename ON photos(filename)',
+    ],
+    # 7: per-user version stamps for cached page fragments, bumped by triggers
+    [
+        'CREATE TABLE IF NOT EXISTS fragment_versions (user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)',
+        *fragment_version_triggers(),
+    ],
+    # 8: materialized top matches per user, and the users whose matches need recomputing
+    [
+        '''CREATE TABLE IF NOT EXISTS match_scores (
+            user_id INTEGER NOT NULL, candidate_id INTEGER NOT NULL, score REAL NOT NULL,
+            PRIMARY KEY (user_id, candidate_id)) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_match_scores_rank ON match_scores (user_id, score DESC, candidate_id)',
+        'CREATE INDEX IF NOT EXISTS idx_match_scores_candidate ON match_scores (candidate_id)',
+        # Size and worst entry of every materialized list; a user without a row has none yet
+        '''CREATE TABLE IF NOT EXISTS match_lists (
+            user_id INTEGER PRIMARY KEY, size INTEGER NOT NULL, min_score REAL, min_candidate_id INTEGER)''',
+        # A new row id on every mark, so a worker only clears the mark it has processed.
+        # propagate = 1: the user's about changed, which touches everyone's list;
+        # 0: only the user's own list needs recomputing
+        'CREATE TABLE IF NOT EXISTS match_dirty (user_id INTEGER NOT NULL UNIQUE, propagate INTEGER NOT NULL)',
+        '''CREATE TRIGGER IF NOT EXISTS users_match_insert AFTER INSERT ON users
+            BEGIN
+                INSERT OR REPLACE INTO match_dirty (user_id, propagate) VALUES (NEW.id, 1);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_match_update AFTER UPDATE OF about ON users
+            WHEN NEW.about IS NOT OLD.about
+            BEGIN
+                INSERT OR REPLACE INTO match_dirty (user_id, propagate) VALUES (NEW.id, 1);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_match_delete AFTER DELETE ON users
+            BEGIN
+                INSERT OR IGNORE INTO match_dirty (user_id, propagate) SELECT user_id, 0 FROM match_scores WHERE candidate_id = OLD.id;
+                DELETE FROM match_scores WHERE candidate_id = OLD.id;
+                DELETE FROM match_scores WHERE user_id = OLD.id;
+                DELETE FROM match_lists WHERE user_id = OLD.id;
+                DELETE FROM match_dirty WHERE user_id = OLD.id;
+            END''',
+    ],
+    # 9: looking_for as one indexed row per accepted gender, for mutual preference filtering
+    [
+        'CREATE TABLE IF NOT EXISTS user_looking_for (gender TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (gender, user_id)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS idx_user_looking_for_user_id ON user_looking_for (user_id)',
+        'DELETE FROM user_looking_for',
+        'INSERT INTO user_looking_for (gender, user_id) ' + accepted_genders_sql('users'),
+        '''CREATE TRIGGER IF NOT EXISTS users_looking_for_insert AFTER INSERT ON users
+            BEGIN
+                INSERT INTO user_looking_for (gender, user_id) ''' + accepted_genders_sql('NEW') + ''';
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_looking_for_update AFTER UPDATE OF looking_for ON users
+            BEGIN
+                DELETE FROM user_looking_for WHERE user_id = OLD.id;
+                INSERT INTO user_looking_for (gender, user_id) ''' + accepted_genders_sql('NEW') + ''';
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_looking_for_delete AFTER DELETE ON users
+            BEGIN
+                DELETE FROM user_looking_for WHERE user_id = OLD.id;
+            END''',
+        # Who is a candidate for whom changes with either field, just like an about edit
+        '''CREATE TRIGGER IF NOT EXISTS users_match_preferences_update AFTER UPDATE OF gender, looking_for ON users
+            WHEN NEW.gender IS NOT OLD.gender OR NEW.looking_for IS NOT OLD.looking_for
+            BEGIN
+                INSERT OR REPLACE INTO match_dirty (user_id, propagate) VALUES (NEW.id, 1);
+            END''',
+        # Lists materialized so far ignored preferences
+        'INSERT OR REPLACE INTO match_dirty (user_id, propagate) SELECT user_id, 0 FROM match_lists',
+    ],
+    # 10: one request per (requester, requestee) and kind, so sending twice is a no-op
+    [
+        *unique_request_pairs('photo_reveals'),
+        *unique_request_pairs('contact_shares'),
+    ],
+    # 11: full-text indexes over profile about texts and contact messages
+    [
+        *full_text_index('users', 'about'),
+        *full_text_index('contact_messages', 'message'),
+    ],
+    # 12: a generation for every change to an about text, so each worker process can catch up on
+    # edits made in the others, and the term segments shared between them
+    [
+        'CREATE TABLE IF NOT EXISTS match_term_changes (generation INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS match_term_segments (generation INTEGER PRIMARY KEY, name TEXT NOT NULL)',
+        '''CREATE TRIGGER IF NOT EXISTS users_terms_insert AFTER INSERT ON users
+            WHEN NEW.about IS NOT NULL
+            BEGIN
+                INSERT INTO match_term_changes (user_id) VALUES (NEW.id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_terms_update AFTER UPDATE OF about ON users
+            WHEN NEW.about IS NOT OLD.about
+            BEGIN
+                INSERT INTO match_term_changes (user_id) VALUES (NEW.id);
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_terms_delete AFTER DELETE ON users
+            BEGIN
+                INSERT INTO match_term_changes (user_id) VALUES (OLD.id);
+            END''',
+    ],
+    # 13: the last run of each maintenance job, claimed by one process at a time
+    [
+        '''CREATE TABLE IF NOT EXISTS maintenance_runs (
+            job TEXT PRIMARY KEY, started REAL NOT NULL, seconds REAL, elapsed REAL, slices INTEGER,
+            removed INTEGER, bytes_reclaimed INTEGER, error TEXT)''',
+    ],
+]
+
+def migrate_db(conn):
+    # BEGIN IMMEDIATE serializes workers starting at the same time; each re-reads
+    # the version under the write lock and only applies what is still missing.
+    retry_on_locked(lambda: conn.execute('BEGIN IMMEDIATE'))
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute('PRAGMA user_version = %d' % number)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# Queries that read a whole table by design and are exempt from the query plan check
+FULL_SCAN_QUERIES = {
+    'SELECT id, about FROM users',
+    "SELECT id FROM users WHERE id != ? AND (gender IN (SELECT value FROM json_each(?)) OR gender IS NULL OR gender NOT IN ('M', 'F', 'O'))",
+    'SELECT user_id, count FROM notification_counters',
+    'SELECT DISTINCT filename FROM photos WHERE thumb_filename IS NULL',
+    'SELECT user_id, size, min_score, min_candidate_id FROM match_lists',
+    'SELECT rowid, user_id, propagate FROM match_dirty ORDER BY rowid LIMIT 1',
+    'SELECT name FROM match_term_segments',
+    # Walks the rowid backwards for one row; the table holds the published segment only anyway
+    'SELECT generation, name FROM match_term_segments ORDER BY generation DESC LIMIT 1',
+    'SELECT * FROM maintenance_runs',
+    "SELECT DISTINCT tbl_name FROM sqlite_schema WHERE type = 'index'",
+}
+
+def app_queries():
+    # Every literal SELECT/UPDATE/DELETE passed to .execute() in this file, or kept as a value in
+    # a dict of statements (REQUEST_SQL) that is looked up and then executed
+    tree = ast.parse(Path(__file__).read_text())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'execute' and node.args:
+            candidates = [node.args[0]]
+        elif isinstance(node, ast.Dict):
+            candidates = node.values
+        else:
+            continue
+        for candidate in candidates:
+            if isinstance(candidate, ast.Constant) and isinstance(candidate.value, str) and candidate.value.strip():
+                sql = candidate.value.strip()
+                if sql.split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+                    yield sql
+
+def check_query_plans(conn):
+    problems = []
+    for sql in sorted(set(app_queries())):
+        if sql in FULL_SCAN_QUERIES:
+            continue
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?')):
+            if row['detail'].startswith('SCAN ') and 'VIRTUAL TABLE' not in row['detail']:
+                problems.append((sql, row['detail']))
+    return problems
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any query in app.py scans a table instead of using an index.
+
+    Queries are planned on an empty in-memory database with the app's schema.
+    Without the statistics ANALYZE gathers, the plans show whether an index
+    can serve each query, not whether today's tables are small enough to scan.
+    """
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    migrate_db(conn)
+    problems = check_query_plans(conn)
+    for sql, detail in problems:
+        click.echo(f'{detail}: {" ".join(sql.split())}')
+    if problems:
+        raise click.ClickException(f'{len(problems)} table scan(s) found')
+    click.echo('No table scans in hot-path queries.')
+
+match_index = create_index(app.config['MATCH_ENGINE'], app.config['VECTOR_STORE_PATH'], app.config['VECTOR_DIM'],
+                           shared=app.config['MATCH_SHARED_MEMORY'])
+shared_match_index = isinstance(match_index, SharedOverlapIndex)
+# The match_term_changes generation this process's index reflects
+match_index_state = {'generation': 0, 'rebuild_queued': False}
+match_index_lock = threading.RLock()
+
+@contextmanager
+def read_snapshot(conn):
+    # Reads in one transaction see a single consistent state of the database
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute('BEGIN')
+    try:
+        yield
+    finally:
+        conn.rollback()
+
+def match_generation(conn):
+    return conn.execute('SELECT MAX(generation) FROM match_term_changes').fetchone()[0] or 0
+
+def build_match_index():
+    """Load the match index at startup: attach the shared term segment, or score from a private copy."""
+    conn = get_db_connection()
+    if shared_match_index:
+        match_index_state['generation'] = None
+        sync_match_index(conn)
+        return
+    with read_snapshot(conn):
+        generation = match_generation(conn)
+        rows = conn.execute('SELECT id, about FROM users').fetchall()
+    match_index.build(rows)
+    match_index_state['generation'] = generation
+
+def attach_match_segment(conn):
+    # Switch to the newest published segment; False when there is none that can be mapped
+    published = conn.execute('SELECT generation, name FROM match_term_segments ORDER BY generation DESC LIMIT 1').fetchone()
+    if published is None:
+        return False
+    if match_index.segment is None or match_index.segment.name != published['name']:
+        try:
+            segment = TermSegment.attach(published['name'])
+        except FileNotFoundError:
+            # Published before a reboot, or by a host sharing the database file
+            return False
+        match_index.attach(segment)
+        match_index_state['generation'] = published['generation']
+    return True
+
+def publish_match_segment(conn, generation):
+    """Build a term segment from the users table and make it the one every worker attaches.
+
+    Processes build one at a time; one that gets its turn after a segment
+    at `generation` or newer was published builds nothing. The users are
+    read in one snapshot with the generation they are at, and changes up to
+    that generation are pruned, since the segment includes them.
+    """
+    with TermSegment.build_lock(app.config['DATABASE'] + '.segments.lock'):
+        published = conn.execute('SELECT generation, name FROM match_term_segments ORDER BY generation DESC LIMIT 1').fetchone()
+        if published is not None and published['generation'] >= generation:
+            try:
+                TermSegment.attach(published['name']).close()
+                return
+            except FileNotFoundError:
+                pass
+        with read_snapshot(conn):
+            generation = match_generation(conn)
+            rows = conn.execute('SELECT id, about FROM users').fetchall()
+        # Unique per database and build, and short enough for macOS's 31 character limit
+        database = hashlib.sha1(app.config['DATABASE'].encode('utf-8')).hexdigest()[:8]
+        segment = TermSegment.create(rows, generation, 'rlk%s_%x_%s' % (database, generation, secrets.token_hex(3)))
+        try:
+            begin_write(conn)
+            replaced = [row['name'] for row in conn.execute('SELECT name FROM match_term_segments')]
+            conn.execute('DELETE FROM match_term_segments WHERE generation <= ?', (generation,))
+            conn.execute('INSERT INTO match_term_segments (generation, name) VALUES (?, ?)', (generation, segment.name))
+            conn.execute('DELETE FROM match_term_changes WHERE generation < ?', (generation,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            segment.unlink()
+            raise
+        segment.close()
+        for name in replaced:
+            TermSegment.unlink_name(name)
+
+def sync_match_index(conn):
+    """Bring this process's match index up to date with about texts changed by any process.
+
+    One indexed query when nothing changed. Otherwise the users changed since
+    are re-read and applied; with the shared index, a newer published segment
+    is attached first, and once too many edits pile up on top of it a fresh
+    one is built in the background.
+    """
+    if match_generation(conn) == match_index_state['generation']:
+        return
+    with match_index_lock:
+        while True:
+            with read_snapshot(conn):
+                if not shared_match_index or attach_match_segment(conn):
+                    changes = conn.execute('''
+                        SELECT match_term_changes.user_id, MAX(match_term_changes.generation) AS generation, users.id IS NOT NULL AS present, users.about
+                        FROM match_term_changes LEFT JOIN users ON users.id = match_term_changes.user_id
+                        WHERE match_term_changes.generation > ? GROUP BY match_term_changes.user_id
+                    ''', (match_index_state['generation'] or 0,)).fetchall()
+                    break
+            publish_match_segment(conn, match_generation(conn))
+        for change in changes:
+            if change['present']:
+                match_index.update(change['user_id'], change['about'])
             else:
-                raise e
-    raise Exception("Database is locked for too long, giving up.")
+                match_index.remove(change['user_id'])
+        if changes:
+            match_index_state['generation'] = max(change['generation'] for change in changes)
+        elif match_index_state['generation'] is None:
+            match_index_state['generation'] = 0
+        if (shared_match_index and match_index.overlay_size > app.config['MATCH_SEGMENT_REBUILD']
+                and not match_index_state['rebuild_queued']):
+            match_index_state['rebuild_queued'] = True
+            match_workers.submit(rebuild_match_segment)
+
+def rebuild_match_segment():
+    # Runs on the match worker; other processes switch to the new segment on their next sync
+    with app.app_context():
+        conn = get_db_connection()
+        try:
+            publish_match_segment(conn, match_generation(conn))
+            with match_index_lock:
+                attach_match_segment(conn)
+            sync_match_index(conn)
+        except Exception as e:
+            print(f"Error rebuilding the match term segment: {e}")
+        finally:
+            match_index_state['rebuild_queued'] = False
+
+lazy_usage = {}
+lazy_usage_lock = threading.Lock()
+
+def request_cached(func):
+    # Computes the value on first access within a request and memoizes it on g.
+    # Which values each endpoint actually touched is tallied in lazy_usage.
+    name = func.__name__[len('get_'):]
+
+    @wraps(func)
+    def wrapper():
+        if name not in g.lazy_values:
+            g.lazy_values[name] = func()
+        return g.lazy_values[name]
+    return wrapper
+
+request_histograms = {
+    'duration': Histogram('relatika_request_duration_seconds', 'Time to handle a request.', SECONDS_BUCKETS),
+    'statements': Histogram('relatika_request_sql_statements', 'SQL statements run per request.', COUNT_BUCKETS),
+    'sql': Histogram('relatika_request_sql_seconds', 'Time spent in SQLite per request.', SECONDS_BUCKETS),
+    'load_user': Histogram('relatika_request_load_user_seconds', 'Time spent loading the signed-in user per request.', SECONDS_BUCKETS),
+    'templates': Histogram('relatika_request_template_seconds', 'Time spent rendering templates per request.', SECONDS_BUCKETS),
+}
+slow_request_log_lock = threading.Lock()
+
+@app.before_request
+def start_request_stats():
+    # Registered before load_user so its connection is charged to the request too
+    g.request_stats = RequestStats(capture_queries=bool(app.config['SLOW_REQUEST_LOG']))
 
 @app.before_request
 def load_user():
+    g.lazy_values = {}
+    g.user = None
+    # Static files are the same for everybody; reading the session would also add Vary: Cookie
+    if request.endpoint == 'static':
+        return
     user_id = session.get('user_id')
     if user_id:
+        started = time.perf_counter()
         conn = get_db_connection()
-        g.user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-        
-        # Load matches
-        all_users = conn.execute('SELECT * FROM users WHERE id != ?', (user_id,)).fetchall()
-
-        current_user_words = re.findall(r'\w+', (g.user['about'] or '').lower())
-        current_user_word_counts = Counter(current_user_words)
-
-        match_list = []
-        for user in all_users:
-            user_words = re.findall(r'\w+', (user['about'] or '').lower())
-            user_word_counts = Counter(user_words)
-            matches = sum((current_user_word_counts & user_word_counts).values())
-            total_words = len(set(current_user_words + user_words))
-            match_percentage = (matches / total_words) * 100 if total_words > 0 else 0
-            user_photo = conn.execute('SELECT filename FROM photos WHERE user_id = ?', (user['id'],)).fetchone()
-
-            # Check if the profile is saved
-            saved = conn.execute('SELECT 1 FROM saved_profiles WHERE user_id = ? AND profile_id = ?', (user_id, user['id'])).fetchone()
-
-            match_list.append({
-                'username': user['username'],
-                'name': user['name'],
-                'age' : user['age'],
-                'location' : user['location'],
-                'match_percentage': round(match_percentage, 2),
-                'user_id': user['id'],
-                'photo': user_photo['filename'] if user_photo else None,
-                'about_glimpse': ' '.join((user['about'] or '').split()[:10]) + '...',
-                'saved': bool(saved)
-            })
- 
-        match_list.sort(key=lambda x: x['match_percentage'], reverse=True)
-        g.matches = match_list
-
-        # Load saved profiles
-        photo_reveals = conn.execute('SELECT requestee_id as user_id FROM photo_reveals WHERE requester_id = ?', (user_id,)).fetchall()
-        contact_shares = conn.execute('SELECT requestee_id as user_id FROM contact_shares WHERE requester_id = ?', (user_id,)).fetchall()
-        heart_likes = conn.execute('SELECT profile_id as user_id FROM saved_profiles WHERE user_id = ?', (user_id,)).fetchall()
-        saved_profiles = list({row['user_id'] for row in photo_reveals + contact_shares + heart_likes})
-
-        if saved_profiles:
-            placeholders = ', '.join(['?'] * len(saved_profiles))
-            users = conn.execute(f'SELECT id, name, age, location, about FROM users WHERE id IN ({placeholders})', tuple(saved_profiles)).fetchall()
-            users_list = [dict(user) for user in users]
-
-            for user in users_list:
-                photo = conn.execute('SELECT filename FROM photos WHERE user_id = ?', (user['id'],)).fetchone()
-                user['photo'] = photo['filename'] if photo else None
-
-            random.shuffle(users_list)
+        g.user = conn.execute('''
+            SELECT users.*, fragment_versions.version AS fragment_version FROM users
+            LEFT JOIN fragment_versions ON fragment_versions.user_id = users.id
+            WHERE users.id = ?
+        ''', (user_id,)).fetchone()
+        if 'request_stats' in g:
+            g.request_stats.load_user_seconds = time.perf_counter() - started
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    # Nested renders (the navigation fragment) are already inside the outer template's time
+    stats = g.get('request_stats')
+    if stats is not None:
+        if stats.template_depth == 0:
+            stats.template_started = time.perf_counter()
+        stats.template_depth += 1
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    stats = g.get('request_stats')
+    if stats is not None:
+        stats.template_depth -= 1
+        if stats.template_depth == 0:
+            stats.template_seconds += time.perf_counter() - stats.template_started
+
+@app.teardown_request
+def record_request_metrics(exc):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return
+    duration = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    request_histograms['duration'].observe(endpoint, duration)
+    request_histograms['statements'].observe(endpoint, stats.statements)
+    request_histograms['sql'].observe(endpoint, stats.sql_seconds)
+    request_histograms['load_user'].observe(endpoint, stats.load_user_seconds)
+    request_histograms['templates'].observe(endpoint, stats.template_seconds)
+    if stats.queries is not None and duration * 1000 >= app.config['SLOW_REQUEST_MS']:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'method': request.method, 'path': request.full_path.rstrip('?'),
+            'endpoint': endpoint, 'duration_ms': round(duration * 1000, 2), 'sql_ms': round(stats.sql_seconds * 1000, 2),
+            'load_user_ms': round(stats.load_user_seconds * 1000, 2), 'template_ms': round(stats.template_seconds * 1000, 2),
+            'statements': [{'sql': ' '.join(sql.split()), 'ms': round(seconds * 1000, 3)} for sql, seconds in stats.queries],
+        }
+        try:
+            with slow_request_log_lock, open(app.config['SLOW_REQUEST_LOG'], 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            print("Error writing slow request log:", e)
+
+@app.teardown_request
+def record_lazy_usage(exc):
+    touched = g.pop('lazy_values', {})
+    with lazy_usage_lock:
+        usage = lazy_usage.setdefault(request.endpoint or 'unmatched', {'requests': 0, 'match_scores': 0, 'notification_count': 0})
+        usage['requests'] += 1
+        for name in touched:
+            usage[name] += 1
+
+EARTH_RADIUS_KM = 6371.0088
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # Haversine great-circle distance
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def nearby_users(conn, latitude, longitude, radius_km):
+    # [(distance_km, user_id)] within radius_km, nearest first. The R*Tree narrows the
+    # search to a bounding box; the exact distance is checked on the few rows inside it.
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = max(-90.0, latitude - lat_delta), min(90.0, latitude + lat_delta)
+    if min_lat == -90.0 or max_lat == 90.0:
+        lon_ranges = [(-180.0, 180.0)]
+    else:
+        lon_delta = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude)))))
+        min_lon, max_lon = longitude - lon_delta, longitude + lon_delta
+        if lon_delta >= 180:
+            lon_ranges = [(-180.0, 180.0)]
+        elif min_lon < -180:
+            lon_ranges = [(min_lon + 360, 180.0), (-180.0, max_lon)]
+        elif max_lon > 180:
+            lon_ranges = [(min_lon, 180.0), (-180.0, max_lon - 360)]
         else:
-            users_list = []
-        g.saved_profiles = users_list
-        
-        # Load Notifications
-        photo_reveal_count = conn.execute('SELECT COUNT(*) FROM photo_reveals WHERE requestee_id = ? AND status = "pending"', (user_id,)).fetchone()[0]
-        contact_share_count = conn.execute('SELECT COUNT(*) FROM contact_shares WHERE requestee_id = ? AND status = "pending"', (user_id,)).fetchone()[0]
-        photo_reveal_sent_count = conn.execute('SELECT COUNT(*) FROM photo_reveals WHERE requester_id = ? AND status <> "pending" AND message != "Acknowledged"', (user_id,)).fetchone()[0]
-        contact_share_sent_count = conn.execute('SELECT COUNT(*) FROM contact_shares WHERE requester_id = ? AND status <> "pending" AND message != "Acknowledged"', (user_id,)).fetchone()[0]
-
-        g.notification_count = int(photo_reveal_count + contact_share_count + photo_reveal_sent_count + contact_share_sent_count)
+            lon_ranges = [(min_lon, max_lon)]
+
+    found = []
+    for min_lon, max_lon in lon_ranges:
+        rows = conn.execute('''
+            SELECT users.id, users.latitude, users.longitude FROM user_locations
+            JOIN users ON users.id = user_locations.id
+            WHERE user_locations.max_lat >= ? AND user_locations.min_lat <= ? AND user_locations.max_lon >= ? AND user_locations.min_lon <= ?
+        ''', (min_lat, max_lat, min_lon, max_lon))
+        for row in rows:
+            distance = distance_km(latitude, longitude, row['latitude'], row['longitude'])
+            if distance <= radius_km:
+                found.append((distance, row['id']))
+    found.sort()
+    return found
+
+def nearest_users(conn, latitude, longitude, count, start_km=5.0):
+    # The `count` nearest [(distance_km, user_id)], widening the radius until enough are found
+    radius_km = start_km
+    while True:
+        found = nearby_users(conn, latitude, longitude, radius_km)
+        if len(found) >= count or radius_km >= math.pi * EARTH_RADIUS_KM:
+            return found[:count]
+        radius_km *= 2
+
+def has_coordinates(user):
+    return isinstance(user['latitude'], (int, float)) and isinstance(user['longitude'], (int, float))
+
+def load_profile_cards(conn, viewer_id, user_ids):
+    # Profile cards for user_ids in three queries however many ids there are, keyed by user id.
+    # Ids travel as one JSON array parameter, so there is no bound-variable limit either.
+    ids = json.dumps(list(user_ids))
+    cards = {}
+    for user in conn.execute('SELECT id, username, name, age, location, about FROM users WHERE id IN (SELECT value FROM json_each(?))', (ids,)):
+        cards[user['id']] = {
+            'username': user['username'],
+            'name': user['name'],
+            'age' : user['age'],
+            'location' : user['location'],
+            'user_id': user['id'],
+            'photo': None,
+            'photo_webp': None,
+            'about_glimpse': ' '.join((user['about'] or '').split()[:10]) + '...',
+            'saved': False
+        }
+    # First photo per user, as a thumbnail once one has been rendered
+    for photo in conn.execute('SELECT user_id, filename, thumb_filename, thumb_webp_filename FROM photos WHERE id IN (SELECT MIN(id) FROM photos WHERE user_id IN (SELECT value FROM json_each(?)) GROUP BY user_id)', (ids,)):
+        if photo['user_id'] in cards:
+            cards[photo['user_id']]['photo'] = photo['thumb_filename'] or photo['filename']
+            cards[photo['user_id']]['photo_webp'] = photo['thumb_webp_filename']
+    for saved in conn.execute('SELECT profile_id FROM saved_profiles WHERE user_id = ? AND profile_id IN (SELECT value FROM json_each(?))', (viewer_id, ids)):
+        if saved['profile_id'] in cards:
+            cards[saved['profile_id']]['saved'] = True
+    return cards
+
+def rank_key(item):
+    # (candidate_id, score) pairs rank best score first, ties by id
+    return (-item[1], item[0])
+
+def write_match_list(conn, user_id, top):
+    # Replace a user's materialized matches with `top`, [(candidate_id, score)] best first
+    conn.execute('DELETE FROM match_scores WHERE user_id = ?', (user_id,))
+    conn.executemany('INSERT INTO match_scores (user_id, candidate_id, score) VALUES (?, ?, ?)',
+                     [(user_id, candidate_id, score) for candidate_id, score in top])
+    worst_id, worst_score = top[-1] if top else (None, None)
+    conn.execute('INSERT OR REPLACE INTO match_lists (user_id, size, min_score, min_candidate_id) VALUES (?, ?, ?, ?)',
+                 (user_id, len(top), worst_score, worst_id))
+
+def compatible_candidates(conn, user):
+    """Ids of the users whose gender `user` is looking for and who are looking for `user`'s gender.
+
+    Runs entirely on indexes, before any text is scored. The test is
+    symmetric, so a user is a candidate for exactly their own candidates.
+    Missing data does not filter: an empty looking_for accepts every
+    gender, and a user without a known gender passes the other side's test.
+    """
+    looking_for = [gender for gender in (user['looking_for'] or '').split(',') if gender in GENDERS] or list(GENDERS)
+    if user['gender'] in GENDERS:
+        rows = conn.execute('''
+            SELECT users.id FROM user_looking_for JOIN users ON users.id = user_looking_for.user_id
+            WHERE user_looking_for.gender = ? AND users.id != ?
+            AND (users.gender IN (SELECT value FROM json_each(?)) OR users.gender IS NULL OR users.gender NOT IN ('M', 'F', 'O'))
+        ''', (user['gender'], user['id'], json.dumps(looking_for)))
+    else:
+        # Only users without a gender of their own get here
+        rows = conn.execute("SELECT id FROM users WHERE id != ? AND (gender IN (SELECT value FROM json_each(?)) OR gender IS NULL OR gender NOT IN ('M', 'F', 'O'))",
+                            (user['id'], json.dumps(looking_for)))
+    return sorted(row['id'] for row in rows)
+
+def top_candidates(conn, user, k):
+    # The k best (candidate_id, score) among the user's compatible candidates; the index selects
+    # them itself, so the vector engines never build a dict of everyone's score
+    return match_index.top_matches(user['about'], k, compatible_candidates(conn, user))
+
+def user_top_matches(conn, user_id):
+    user = conn.execute('SELECT id, about, gender, looking_for FROM users WHERE id = ?', (user_id,)).fetchone()
+    return None if user is None else top_candidates(conn, user, app.config['MATCH_LIST_SIZE'])
+
+def refresh_match_scores(conn, user_id):
+    """Recompute the materialized matches involving a user whose `about` changed.
+
+    The user is scored once against everybody. That gives their own list,
+    and since scores are symmetric, also their new score in every other
+    list: it is written where it now ranks among the best, and dropped
+    where it no longer does. Only a list the user falls out of from the
+    inside has to be recomputed from scratch, as the best replacement is
+    unknown. Lists not materialized yet are left alone; those users are
+    scored live until theirs is written. The 'tfidf' and 'bm25' engines
+    weigh words by corpus-wide statistics (and bm25 is not quite
+    symmetric), so with them other lists are approximate until the next
+    rebuild.
+    """
+    size = app.config['MATCH_LIST_SIZE']
+    user = conn.execute('SELECT id, about, gender, looking_for FROM users WHERE id = ?', (user_id,)).fetchone()
+    if user is None:
+        return
+    scores = match_index.match_percentages(user['about'], compatible_candidates(conn, user))
+    lists = {row['user_id']: row for row in conn.execute('SELECT user_id, size, min_score, min_candidate_id FROM match_lists')}
+    listed_by = {row['user_id'] for row in conn.execute('SELECT user_id FROM match_scores WHERE candidate_id = ?', (user_id,))}
+
+    # Lists the user is no longer a candidate for lose them from the inside
+    rescored = [(other_id, user_top_matches(conn, other_id)) for other_id in listed_by if other_id not in scores]
+    updates, inserts = [], []
+    for other_id, score in scores.items():
+        state = lists.get(other_id)
+        if state is None:
+            continue
+        full = state['size'] >= size
+        ranks = not full or rank_key((user_id, score)) <= rank_key((state['min_candidate_id'], state['min_score']))
+        if other_id in listed_by:
+            if ranks:
+                updates.append((score, other_id, user_id))
+            else:
+                rescored.append((other_id, user_top_matches(conn, other_id)))
+        elif ranks:
+            inserts.append((other_id, full))
+
+    write_match_list(conn, user_id, heapq.nsmallest(size, scores.items(), key=rank_key))
+    conn.executemany('UPDATE match_scores SET score = ? WHERE user_id = ? AND candidate_id = ?', updates)
+    for other_id, full in inserts:
+        conn.execute('INSERT INTO match_scores (user_id, candidate_id, score) VALUES (?, ?, ?)', (other_id, user_id, scores[other_id]))
+        if full:
+            conn.execute('DELETE FROM match_scores WHERE user_id = ? AND candidate_id = ?', (other_id, lists[other_id]['min_candidate_id']))
+    for other_id, top in rescored:
+        if top is not None:
+            write_match_list(conn, other_id, top)
+    # The worst entry of every list touched above may have changed
+    for other_id in {other_id for _, other_id, _ in updates} | {other_id for other_id, _ in inserts}:
+        worst = conn.execute('SELECT candidate_id, score FROM match_scores WHERE user_id = ? ORDER BY score, candidate_id DESC LIMIT 1',
+                             (other_id,)).fetchone()
+        conn.execute('UPDATE match_lists SET size = (SELECT COUNT(*) FROM match_scores WHERE user_id = ?), min_score = ?, min_candidate_id = ? WHERE user_id = ?',
+                     (other_id, worst['score'], worst['candidate_id'], other_id))
+
+match_workers = ThreadPoolExecutor(max_workers=1, thread_name_prefix='match-scores')
+
+def refresh_dirty_matches():
+    # Runs on the match worker, off the request thread, until no user is marked dirty
+    with app.app_context():
+        conn = get_db_connection()
+        while True:
+            dirty = conn.execute('SELECT rowid, user_id, propagate FROM match_dirty ORDER BY rowid LIMIT 1').fetchone()
+            if dirty is None:
+                return
+            try:
+                # Another process may have made the edit; bring this process's index up to date first
+                sync_match_index(conn)
+                if dirty['propagate']:
+                    refresh_match_scores(conn, dirty['user_id'])
+                else:
+                    top = user_top_matches(conn, dirty['user_id'])
+                    if top is not None:
+                        write_match_list(conn, dirty['user_id'], top)
+                # Marked again meanwhile means a new row id, and another pass
+                conn.execute('DELETE FROM match_dirty WHERE rowid = ?', (dirty['rowid'],))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Error refreshing matches of user {dirty['user_id']}: {e}")
+                return
+
+def queue_match_refresh():
+    if app.config['MATCH_LIST_SIZE']:
+        match_workers.submit(refresh_dirty_matches)
+
+def store_match_list(user_id, top):
+    # Materializes a list that was scored live because none had been written yet
+    with app.app_context():
+        conn = get_db_connection()
+        try:
+            write_match_list(conn, user_id, top)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error storing matches of user {user_id}: {e}")
+
+def top_match_lists(user_ids):
+    # Runs in a rebuild worker process, on a connection of its own: [(user_id, top matches)]
+    conn = connect_db()
+    try:
+        return [(user_id, user_top_matches(conn, user_id)) for user_id in user_ids]
+    finally:
         conn.close()
+
+@app.cli.command('rebuild-match-scores')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, type=int, help='Scoring processes.')
+@click.option('--batch', default=256, show_default=True, type=int, help='Users per task and per transaction.')
+def rebuild_match_scores_command(workers, batch):
+    """Recompute every user's materialized matches, scoring in parallel processes."""
+    size = app.config['MATCH_LIST_SIZE']
+    if not size:
+        raise click.ClickException('MATCH_LIST_SIZE is not set')
+    conn = get_db_connection()
+    # Clear the marks before reading the users: edits from here on are marked again and refreshed after
+    conn.execute('DELETE FROM match_dirty')
+    conn.commit()
+    users = conn.execute('SELECT id, about FROM users').fetchall()
+    match_index.build(users)
+    batches = [[row['id'] for row in users[start:start + batch]] for start in range(0, len(users), batch)]
+    # Forked workers share the index just built instead of each rebuilding it
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        for done, lists in enumerate(pool.map(top_match_lists, batches), start=1):
+            for user_id, top in lists:
+                if top is not None:
+                    write_match_list(conn, user_id, top)
+            conn.commit()
+            click.echo(f'\r{min(done * batch, len(users))}/{len(users)} users', nl=False)
+    click.echo(f'\nRebuilt match lists of {len(users)} users in {time.perf_counter() - started:.1f} s.')
+
+@request_cached
+def get_match_scores():
+    # {user_id: match percentage as displayed} for every candidate of the current user
+    if not g.user:
+        return {}
+    user_id = g.user['id']
+    conn = get_db_connection()
+    if (app.config['MATCH_RADIUS_KM'] or app.config['MATCH_NEAREST']) and has_coordinates(g.user):
+        # Spatial pre-filter: only users close by are scored at all
+        sync_match_index(conn)
+        if app.config['MATCH_RADIUS_KM']:
+            nearby = nearby_users(conn, g.user['latitude'], g.user['longitude'], app.config['MATCH_RADIUS_KM'])
+        else:
+            # One more, as the user is the nearest of all
+            nearby = nearest_users(conn, g.user['latitude'], g.user['longitude'], app.config['MATCH_NEAREST'] + 1)
+        compatible = set(compatible_candidates(conn, g.user))
+        candidate_ids = sorted(candidate_id for _, candidate_id in nearby if candidate_id in compatible)
+        match_percentages = match_index.match_percentages(g.user['about'], candidate_ids)
+    elif app.config['MATCH_LIST_SIZE']:
+        match_percentages = {row['candidate_id']: row['score'] for row in
+                             conn.execute('SELECT candidate_id, score FROM match_scores WHERE user_id = ?', (user_id,))}
+        # An empty list is materialized too when the user has no compatible candidates; only a
+        # missing match_lists row means the list was never written
+        if not match_percentages and conn.execute('SELECT 1 FROM match_lists WHERE user_id = ?', (user_id,)).fetchone() is None:
+            # Not materialized yet: score live this once and store the list in the background
+            sync_match_index(conn)
+            top_matches = top_candidates(conn, g.user, app.config['MATCH_LIST_SIZE'])
+            match_workers.submit(store_match_list, user_id, top_matches)
+            match_percentages = dict(top_matches)
+        candidate_ids = list(match_percentages)
+    elif app.config['MATCH_TOP_K']:
+        sync_match_index(conn)
+        top_matches = top_candidates(conn, g.user, app.config['MATCH_TOP_K'])
+        candidate_ids = [candidate_id for candidate_id, _ in top_matches]
+        match_percentages = dict(top_matches)
     else:
-        g.user = None
-        g.matches = []
-        g.saved_profiles = []
-        g.notification_count = 0
+        sync_match_index(conn)
+        candidate_ids = compatible_candidates(conn, g.user)
+        match_percentages = match_index.match_percentages(g.user['about'], candidate_ids)
+    return {candidate_id: round(match_percentages[candidate_id], 2) for candidate_id in candidate_ids}
+
+def match_page(after=None, limit=None):
+    """One page of the current user's matches, best score first and ties by id.
+
+    `after` is the (score, user_id) of the last match already shown. Only
+    the page is turned into profile cards, so a page costs the same however
+    many candidates were scored. Returns (cards, (score, user_id) of the
+    last card or None when nothing follows).
+    """
+    scores = get_match_scores()
+    keys = ((-score, candidate_id) for candidate_id, score in scores.items())
+    if after is not None:
+        after_key = (-after[0], after[1])
+        keys = (key for key in keys if key > after_key)
+    page = heapq.nsmallest(limit + 1 if limit else len(scores), keys)
+    has_more = limit is not None and len(page) > limit
+    page = page[:limit]
+    cards = load_profile_cards(get_db_connection(), g.user['id'], [candidate_id for _, candidate_id in page]) if page else {}
+    match_list = []
+    for negative_score, candidate_id in page:
+        if candidate_id in cards:
+            cards[candidate_id]['match_percentage'] = -negative_score
+            match_list.append(cards[candidate_id])
+    return match_list, (-page[-1][0], page[-1][1]) if has_more else None
+
+def saved_page(after=None, limit=None):
+    """One page of the profiles the user has saved or sent a request to, ordered by id.
+
+    `after` is the last user id already shown. Returns (cards, user id of
+    the last card or None when nothing follows).
+    """
+    if not g.user:
+        return [], None
+    user_id = g.user['id']
+    conn = get_db_connection()
+    after = after or 0
+    saved_ids = [row['user_id'] for row in conn.execute('''
+        SELECT requestee_id AS user_id FROM photo_reveals WHERE requester_id = ? AND requestee_id > ?
+        UNION SELECT requestee_id FROM contact_shares WHERE requester_id = ? AND requestee_id > ?
+        UNION SELECT profile_id FROM saved_profiles WHERE user_id = ? AND profile_id > ?
+        ORDER BY user_id LIMIT ?
+    ''', (user_id, after, user_id, after, user_id, after, limit + 1 if limit else -1))]
+    has_more = limit is not None and len(saved_ids) > limit
+    saved_ids = saved_ids[:limit]
+    cards = load_profile_cards(conn, user_id, saved_ids)
+    return [cards[saved_id] for saved_id in saved_ids if saved_id in cards], saved_ids[-1] if has_more else None
+
+def new_browse_deck(conn):
+    # Leave headroom above the current max id so users who sign up later are dealt from the same deck
+    max_id = conn.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0
+    return [random.getrandbits(31), max_id + max(64, max_id // 4), 0]
+
+def draw_profile_id(conn, user_id):
+    """Deal the next profile id from the session's shuffled deck of user ids.
+
+    The deck is a seeded permutation of the id range, so it lives in the
+    session as (seed, limit, position) and never shows a profile twice
+    until every id has been dealt. Ids of deleted users are skipped by
+    checking a batch of upcoming positions against the users table at once.
+    """
+    for fresh in (False, True):
+        deck = session.get('browse_deck')
+        if fresh or not deck:
+            deck = new_browse_deck(conn)
+        seed, limit, position = deck
+        positions = shuffled_positions(seed, limit, position)
+        while True:
+            batch = [(position, value + 1) for position, value in islice(positions, app.config['BROWSE_BATCH_SIZE'])]
+            if not batch:
+                break
+            existing = {row['id'] for row in conn.execute('SELECT id FROM users WHERE id IN (SELECT value FROM json_each(?))',
+                                                          (json.dumps([profile_id for _, profile_id in batch]),))}
+            for position, profile_id in batch:
+                if profile_id in existing and profile_id != user_id:
+                    session['browse_deck'] = [seed, limit, position + 1]
+                    return profile_id
+    # Nobody left to show even after reshuffling
+    session.pop('browse_deck', None)
+    return None
+
+def read_notification_count(conn, user_id):
+    row = conn.execute('SELECT count FROM notification_counters WHERE user_id = ?', (user_id,)).fetchone()
+    return row['count'] if row else 0
+
+def check_notification_counters(conn, fix=False):
+    # Recompute every counter from scratch; returns [(user_id, stored, expected)] that drifted
+    expected = {row['user_id']: row['count'] for row in conn.execute(NOTIFICATION_COUNTS_SQL)}
+    stored = {row['user_id']: row['count'] for row in conn.execute('SELECT user_id, count FROM notification_counters')}
+    drift = [(user_id, stored.get(user_id, 0), expected.get(user_id, 0))
+             for user_id in sorted(expected.keys() | stored.keys())
+             if stored.get(user_id, 0) != expected.get(user_id, 0)]
+    if fix and drift:
+        conn.executemany('INSERT INTO notification_counters (user_id, count) VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET count = excluded.count',
+                         [(user_id, count) for user_id, _, count in drift])
+        conn.commit()
+    return drift
+
+@app.cli.command('check-notification-counters')
+@click.option('--fix', is_flag=True, help='Overwrite drifted counters with the recomputed values.')
+def check_notification_counters_command(fix):
+    """Recompute notification counters from scratch and report drift."""
+    drift = check_notification_counters(get_db_connection(), fix=fix)
+    for user_id, stored, expected in drift:
+        click.echo(f'user {user_id}: stored {stored}, expected {expected}')
+    if drift and not fix:
+        raise click.ClickException(f'{len(drift)} counter(s) drifted')
+    click.echo(f'{len(drift)} counter(s) fixed.' if drift else 'Notification counters are consistent.')
+
+@request_cached
+def get_notification_count():
+    if not g.user:
+        return 0
+    return read_notification_count(get_db_connection(), g.user['id'])
+
+notification_broker = NotificationBroker()
+
+def notification_event(conn, user_id, message=None):
+    return {'count': read_notification_count(conn, user_id), 'message': message}
+
+def write_notification_event(conn, user_id, message=None):
+    # The outbox row is part of the caller's transaction; publish_notifications() pushes it after the commit
+    cursor = conn.execute('INSERT INTO notification_events (user_id, message, origin) VALUES (?, ?, ?)', (user_id, message, os.getpid()))
+    if cursor.lastrowid % 1000 == 0:
+        conn.execute('DELETE FROM notification_events WHERE id <= ?', (cursor.lastrowid - app.config['NOTIFICATION_OUTBOX_KEEP'],))
+
+def publish_notifications(conn):
+    # Subscribers in this process get the event now; stream servers elsewhere relay it from the outbox
+    for user_id, message in g.pop('pending_notifications', []):
+        if notification_broker.has_subscribers(user_id):
+            notification_broker.publish(user_id, notification_event(conn, user_id, message))
+
+def begin_write(conn):
+    retry_on_locked(lambda: conn.execute('BEGIN IMMEDIATE'))
+
+social_writes = WriteQueue(connect_db, begin_write, app.config['WRITE_BATCH_SIZE'])
+
+def social_write(conn, func, args):
+    # Runs on the writer thread: the action and its outbox rows share one savepoint
+    result, notifications = func(conn, *args)
+    for user_id, message in notifications:
+        write_notification_event(conn, user_id, message)
+    return result, notifications
+
+def run_social_write(func, *args):
+    """Run func(conn, *args) in the writer's next transaction and publish what it notifies.
+
+    func returns (result, [(user_id, message), ...]) and must only touch the
+    connection it is given. Returns the result once it has been committed.
+    """
+    result, notifications = social_writes.submit(social_write, func, args).result(timeout=app.config['WRITE_TIMEOUT'])
+    g.setdefault('pending_notifications', []).extend(notifications)
+    publish_notifications(get_db_connection())
+    return result
+
+def relay_notifications(after_id):
+    # Outbox events written by other processes since after_id, with the recipients' current counts
+    with app.app_context():
+        conn = get_db_connection()
+        if after_id is None:
+            return conn.execute('SELECT MAX(id) FROM notification_events').fetchone()[0] or 0, []
+        rows = conn.execute('''
+            SELECT notification_events.id, notification_events.user_id, notification_events.message, notification_events.origin,
+                   notification_counters.count
+            FROM notification_events
+            LEFT JOIN notification_counters ON notification_counters.user_id = notification_events.user_id
+            WHERE notification_events.id > ?
+            ORDER BY notification_events.id
+        ''', (after_id,)).fetchall()
+    if not rows:
+        return after_id, []
+    events = [(row['user_id'], {'count': row['count'] or 0, 'message': row['message']}) for row in rows if row['origin'] != os.getpid()]
+    return rows[-1]['id'], events
+
+def session_user_id(cookies):
+    # Flask's signed session cookie, checked without a request context
+    value = cookies.get(app.config['SESSION_COOKIE_NAME'])
+    serializer = app.session_interface.get_signing_serializer(app)
+    if value is None or serializer is None:
+        return None
+    try:
+        return serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds())).get('user_id')
+    except BadSignature:
+        return None
+
+def first_notification_event(user_id):
+    with app.app_context():
+        return notification_event(get_db_connection(), user_id)
+
+def create_notification_stream(host='127.0.0.1', port=0):
+    return StreamServer(notification_broker, session_user_id, first_notification_event, relay=relay_notifications,
+                        path='/notifications/stream', host=host, port=port)
+
+@app.cli.command('notification-stream')
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=5001, show_default=True, type=int)
+def notification_stream_command(host, port):
+    """Serve /notifications/stream from a standalone asyncio server."""
+    click.echo(f'Streaming notifications on http://{host}:{port}/notifications/stream')
+    create_notification_stream(host, port).serve_forever()
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'])
+
+def render_navigation():
+    # base.html's per-user navigation, re-rendered only after a write bumped the user's fragment version
+    if not g.user:
+        key, version = None, 0
+    else:
+        key, version = g.user['id'], g.user['fragment_version'] or 0
+    html = fragment_cache.get(key, version)
+    if html is None:
+        saved_count = 0
+        if g.user:
+            user_id = g.user['id']
+            saved_count = len(get_db_connection().execute('''
+                SELECT requestee_id FROM photo_reveals WHERE requester_id = ?
+                UNION SELECT requestee_id FROM contact_shares WHERE requester_id = ?
+                UNION SELECT profile_id FROM saved_profiles WHERE user_id = ?
+            ''', (user_id, user_id, user_id)).fetchall())
+        html = render_template('_navigation.html', saved_count=saved_count)
+        fragment_cache.put(key, version, html)
+    return Markup(html)
 
 @app.context_processor
 def inject_user():
-    return dict(user=g.user, matches=g.matches, saved_profiles=g.saved_profiles,notification_count = g.notification_count)
+    # The proxy defers the notification count until a template reads it; match and saved
+    # lists are passed page by page by the views that show them
+    return dict(user=g.user, notification_count=LocalProxy(get_notification_count), navigation=render_navigation)
+
+asset_manifest = AssetManifest(app.static_folder, app.config['ASSET_CACHE_FOLDER'])
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    # url_for('static', ...) carries the file's content hash, so browsers can cache it forever
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = asset_manifest.version(values['filename'])
+        if version:
+            values['v'] = version
+
+def serve_static(filename):
+    asset = asset_manifest.asset(filename)
+    if asset is None:
+        abort(404)
+    encoding, path = asset.negotiate(request.accept_encodings)
+    fingerprinted = request.args.get('v') == asset.version
+    # Unversioned or outdated URLs still revalidate with the ETag every time
+    response = send_file(path, mimetype=asset.mimetype, etag=asset.etag(encoding), conditional=True,
+                         max_age=app.config['ASSET_MAX_AGE'] if fingerprinted else None)
+    if fingerprinted:
+        response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+    return response
+
+app.view_functions['static'] = serve_static
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    # Cursors are opaque to clients: base64url JSON of the last position they were shown
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        abort(400)
+
+def page_size():
+    limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+    return min(max(limit, 1), app.config['API_MAX_PAGE_SIZE'])
+
+def api_card(card):
+    photo = card['photo']
+    item = {
+        'user_id': card['user_id'],
+        'name': card['name'],
+        'age': card['age'],
+        'location': card['location'],
+        'about_glimpse': card['about_glimpse'],
+        'saved': card['saved'],
+        'profile_url': url_for('view_profile', user_id=card['user_id']),
+        'photo_url': url_for('static', filename='uploads/' + photo) if photo else None,
+        'photo_webp_url': url_for('static', filename='uploads/' + card['photo_webp']) if card['photo_webp'] else None,
+    }
+    if 'match_percentage' in card:
+        item['match_percentage'] = card['match_percentage']
+    return item
+
+def full_text_query(text):
+    # Every word of `text` must appear, the last one possibly unfinished; quoting each word
+    # keeps FTS5 operators and punctuation in user input from being parsed as query syntax
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    return ' '.join('"%s"' % word for word in words) + '*'
+
+def search_page(table, text, after=None, limit=None):
+    """Ids of `table` rows whose full-text index matches `text`, best match first.
+
+    Ranked by bm25 and paged by keyset: `after` is the (rank, id) of the last
+    row already shown. Returns (ids, (rank, id) of the last one or None when
+    nothing follows).
+    """
+    query = full_text_query(text)
+    if query is None:
+        return [], None
+    index = f'{table}_fts'
+    keyset = 'AND (rank > ? OR (rank = ? AND rowid > ?))' if after else ''
+    parameters = (query, *((after[0], after[0], after[1]) if after else ()), limit + 1 if limit else -1)
+    rows = get_db_connection().execute(f'''
+        SELECT rowid, rank FROM {index} WHERE {index} MATCH ? {keyset}
+        ORDER BY rank, rowid LIMIT ?
+    ''', parameters).fetchall()
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    return [row['rowid'] for row in rows], (rows[-1]['rank'], rows[-1]['rowid']) if has_more else None
+
+def search_cursor():
+    after = decode_cursor(request.args.get('cursor'))
+    if after is not None and not (isinstance(after, list) and len(after) == 2 and isinstance(after[0], (int, float))
+                                  and isinstance(after[1], int)):
+        abort(400)
+    return after
+
+def contact_message_rows(conn, message_ids):
+    rows = conn.execute('SELECT id, name, email, message FROM contact_messages WHERE id IN (SELECT value FROM json_each(?))',
+                        (json.dumps(message_ids),)).fetchall()
+    by_id = {row['id']: row for row in rows}
+    return [by_id[message_id] for message_id in message_ids if message_id in by_id]
 
 @app.route('/')
 def home():
@@ -122,9 +1433,28 @@ def dashboard():
     user_id = session['user_id']
     conn = get_db_connection()
     user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
     return render_template('dashboard.html', username=user['username'])
 
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_WORKERS'],
+                                 app.config['PASSWORD_QUEUE_LIMIT'], app.config['PASSWORD_TIMEOUT'])
+
+def too_busy(template):
+    # Cheap to send, so a burst of sign-ins doesn't hold request workers waiting on the hasher
+    return render_template(template, error="We're getting a lot of sign-ins right now. Please try again in a few seconds."), 503, {'Retry-After': '5'}
+
+def upgrade_password_hash(conn, user, password):
+    """Store `password` hashed with the current method, if the hasher has room for it.
+
+    Skipped while the hasher is busy; the next login tries again. Matching on
+    the old hash keeps a password changed meanwhile from being overwritten.
+    """
+    try:
+        password_hash = password_hasher.hash(password)
+    except HasherBusy:
+        return
+    conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?', (password_hash, user['id'], user['password']))
+    conn.commit()
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -151,13 +1481,16 @@ def register():
         conn = get_db_connection()
         existing_user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         if existing_user:
-            conn.close()
             return render_template('register.html', error="Username already exists")
 
+        try:
+            password_hash = password_hasher.hash(password)
+        except HasherBusy:
+            return too_busy('register.html')
         conn.execute('INSERT INTO users (username, password, name, age, gender, looking_for, location, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', 
-                     (username, generate_password_hash(password), name, age, gender, ','.join(looking_for), location, latitude, longitude))
+                     (username, password_hash, name, age, gender, ','.join(looking_for), location, latitude, longitude))
         conn.commit()
-        conn.close()
+        queue_match_refresh()
         return redirect(url_for('login'))
     return render_template('register.html')
 
@@ -170,12 +1503,16 @@ def login():
         conn = get_db_connection()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         
-        if user and check_password_hash(user['password'], password):
+        try:
+            valid = user is not None and password_hasher.verify(user['password'], password)
+        except HasherBusy:
+            return too_busy('login.html')
+        if valid:
+            if password_hasher.needs_rehash(user['password']):
+                upgrade_password_hash(conn, user, password)
             session['user_id'] = user['id']
-            conn.close()
             return redirect(url_for('ai_suggestions'))
         else:
-            conn.close()
             error = 'Invalid username or password'
             return render_template('login.html', error=error)
     return render_template('login.html')
@@ -185,6 +1522,65 @@ def logout():
     session.pop('user_id', None)
     return redirect(url_for('home'))
 
+photo_workers = ThreadPoolExecutor(max_workers=app.config['PHOTO_WORKERS'], thread_name_prefix='photo-variants')
+
+def build_photo_variants(filename):
+    # Runs on the photo worker pool, off the request thread
+    try:
+        thumb_filename, thumb_webp_filename = photos.make_variants(app.config['UPLOAD_FOLDER'], filename, app.config['PHOTO_THUMB_SIZE'])
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"Error building variants of photo {filename}: {e}")
+        return
+    with app.app_context():
+        conn = get_db_connection()
+        conn.execute('UPDATE photos SET thumb_filename = ?, thumb_webp_filename = ? WHERE filename = ?', (thumb_filename, thumb_webp_filename, filename))
+        conn.commit()
+
+def queue_photo_variants(filename):
+    if photos.Image is not None:
+        photo_workers.submit(build_photo_variants, filename)
+
+def queue_missing_photo_variants():
+    # Uploads from before variants existed, or whose job was lost with its process
+    conn = get_db_connection()
+    for row in conn.execute('SELECT DISTINCT filename FROM photos WHERE thumb_filename IS NULL').fetchall():
+        queue_photo_variants(row['filename'])
+
+def save_photo(conn, user_id, upload):
+    """Store an upload under its content hash and record it for user_id.
+
+    The row is committed before the file gets its final name, so a
+    concurrent delete of the same content never removes it from under us.
+    """
+    spooled = photos.spool_upload(upload.stream, upload.filename, app.config['UPLOAD_FOLDER'])
+    if spooled is None:
+        return
+    content_hash, filename, temporary = spooled
+    variants = None
+    try:
+        if not conn.execute('SELECT 1 FROM photos WHERE user_id = ? AND filename = ?', (user_id, filename)).fetchone():
+            # Identical content uploaded before already has its thumbnails
+            variants = conn.execute('SELECT thumb_filename, thumb_webp_filename FROM photos WHERE filename = ? AND thumb_filename IS NOT NULL LIMIT 1', (filename,)).fetchone()
+            conn.execute('INSERT INTO photos (user_id, filename, content_hash, thumb_filename, thumb_webp_filename) VALUES (?, ?, ?, ?, ?)',
+                         (user_id, filename, content_hash, *(variants or (None, None))))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        os.remove(temporary)
+        raise
+    photos.place_upload(temporary, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    if variants is None:
+        queue_photo_variants(filename)
+
+def release_photos(conn, filenames):
+    # Call inside the transaction that deleted the rows: files go only once no row references them,
+    # and holding the write lock keeps a concurrent upload of the same content from slipping in between
+    for filename in set(filenames):
+        if not conn.execute('SELECT 1 FROM photos WHERE filename = ? LIMIT 1', (filename,)).fetchone():
+            photos.remove_upload(app.config['UPLOAD_FOLDER'], filename)
+
 @app.route('/profile', methods=['GET', 'POST'])
 def profile():
     if 'user_id' not in session:
@@ -209,20 +1605,18 @@ def profile():
         conn.execute('UPDATE users SET name = ?, age = ?, gender = ?, looking_for = ?, location = ?, latitude = ?, longitude = ?, about = ?, email = ?, tel = ?, instagram = ?, telegram = ? WHERE id = ?', 
                      (name, age, gender, looking_for, location, latitude, longitude, about, email, tel, instagram, telegram, user_id))
         conn.commit()
+        match_index.update(user_id, about)
+        queue_match_refresh()
         
-        photos = request.files.getlist('photos')
-        for photo in photos:
-            if photo.filename != '':
-                photo_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.filename)
-                photo.save(photo_path)
-                conn.execute('INSERT INTO photos (user_id, filename) VALUES (?, ?)', (user_id, photo.filename))
-                conn.commit()
+        uploads = request.files.getlist('photos')
+        for upload in uploads:
+            if upload.filename != '':
+                save_photo(conn, user_id, upload)
 
         return jsonify(status='success')
 
     user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
     user_photos = conn.execute('SELECT filename FROM photos WHERE user_id = ?', (user_id,)).fetchall()
-    conn.close()
     return render_template('profile.html', user_name=user['name'], user_age=user['age'], user_gender=user['gender'], 
                            user_looking_for=user['looking_for'] or '', user_location=user['location'], user_latitude=user['latitude'], user_longitude=user['longitude'],
                            user_about=user['about'] or '', user_email=user['email'] or '', user_tel=user['tel'] or '', user_instagram=user['instagram'] or '', user_telegram=user['telegram'] or '',
@@ -234,10 +1628,12 @@ def browse():
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    user = conn.execute('SELECT id, name, age, location, about FROM users ORDER BY RANDOM() LIMIT 1').fetchone()
+    profile_id = draw_profile_id(conn, session['user_id'])
+    if profile_id is None:
+        return redirect(url_for('dashboard'))
+    user = conn.execute('SELECT id, name, age, location, about FROM users WHERE id = ?', (profile_id,)).fetchone()
     # Fetch photos for random user
     user_photos = conn.execute('SELECT filename FROM photos WHERE user_id = ?', (user['id'],)).fetchall()
-    conn.close()
 
     return render_template('browse.html', user=user, user_photos=user_photos)
 
@@ -246,30 +1642,15 @@ def saved():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    user_id = session['user_id']
-    conn = get_db_connection()
-    
-    # Fetch profiles the user has interacted with
-    photo_reveals = conn.execute('SELECT requestee_id as user_id FROM photo_reveals WHERE requester_id = ?', (user_id,)).fetchall()
-    contact_shares = conn.execute('SELECT requestee_id as user_id FROM contact_shares WHERE requester_id = ?', (user_id,)).fetchall()
-    heart_likes = conn.execute('SELECT profile_id as user_id FROM saved_profiles WHERE user_id = ?', (user_id,)).fetchall()
-    saved_profiles = list({row['user_id'] for row in photo_reveals + contact_shares + heart_likes})
-
-    if saved_profiles:
-        placeholders = ', '.join(['?'] * len(saved_profiles))
-        users = conn.execute(f'SELECT id, name, age, location, about FROM users WHERE id IN ({placeholders})', tuple(saved_profiles)).fetchall()
-        users_list = [dict(user) for user in users]
-
-        for user in users_list:
-            photo = conn.execute('SELECT filename FROM photos WHERE user_id = ?', (user['id'],)).fetchone()
-            user['photo'] = photo['filename'] if photo else None
-
-        random.shuffle(users_list)
-    else:
-        users_list = []
+    users, last = saved_page(limit=app.config['API_PAGE_SIZE'])
+    return render_template('saved.html', users=users, next_cursor=last and encode_cursor(last))
 
-    conn.close()
-    return render_template('saved.html', users=users_list)
+def toggle_saved_profile(conn, user_id, profile_id):
+    # Whether the profile is saved afterwards
+    if conn.execute('DELETE FROM saved_profiles WHERE user_id = ? AND profile_id = ? RETURNING 1', (user_id, profile_id)).fetchall():
+        return False, []
+    conn.execute('INSERT INTO saved_profiles (user_id, profile_id) VALUES (?, ?)', (user_id, profile_id))
+    return True, []
 
 @app.route('/save_profile/<int:profile_id>', methods=['POST'])
 def save_profile(profile_id):
@@ -277,23 +1658,13 @@ def save_profile(profile_id):
         return jsonify({'status': 'error', 'message': 'Unauthorized'})
 
     user_id = session['user_id']
-    conn = get_db_connection()
     try:
-        saved = conn.execute('SELECT 1 FROM saved_profiles WHERE user_id = ? AND profile_id = ?', (user_id, profile_id)).fetchone()
-        if saved:
-            conn.execute('DELETE FROM saved_profiles WHERE user_id = ? AND profile_id = ?', (user_id, profile_id))
-            message = 'Profile unsaved successfully'
-        else:
-            conn.execute('INSERT INTO saved_profiles (user_id, profile_id) VALUES (?, ?)', (user_id, profile_id))
-            message = 'Profile saved successfully'
-        conn.commit()
+        saved = run_social_write(toggle_saved_profile, user_id, profile_id)
     except Exception as e:
         print(f"Error saving profile {profile_id} for user {user_id}: {e}")
         return jsonify({'status': 'error', 'message': 'Failed to save/unsave profile'})
-    finally:
-        conn.close()
 
-    return jsonify({'status': 'success', 'message': message})
+    return jsonify({'status': 'success', 'message': 'Profile saved successfully' if saved else 'Profile unsaved successfully'})
 
 
 @app.route('/delete_photo/<filename>', methods=['POST'])
@@ -304,12 +1675,8 @@ def delete_photo(filename):
     user_id = session['user_id']
     conn = get_db_connection()
     conn.execute('DELETE FROM photos WHERE user_id = ? AND filename = ?', (user_id, filename))
+    release_photos(conn, [filename])
     conn.commit()
-    conn.close()
-
-    photo_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(photo_path):
-        os.remove(photo_path)
 
     return jsonify({'status': 'success'})
 
@@ -318,18 +1685,21 @@ def next_random_profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    user_id = session['user_id']
-    
-    if 'matches' in g and isinstance(g.matches, list):
-        match_ids = [match['user_id'] for match in g.matches]
-        if match_ids:
-            random.shuffle(match_ids)
-            return jsonify({'user_id': match_ids[0]})
+    profile_id = draw_profile_id(get_db_connection(), session['user_id'])
+    if profile_id is None:
+        return jsonify({'status': 'error', 'message': 'No more profiles to show'}), 404
+    return jsonify({'user_id': profile_id})
 
 @app.route('/send_superlike/<int:user_id>', methods=['POST'])
 def send_superlike(user_id):
-    send_photo_reveal_request(user_id)
-    send_contact_share_request(user_id)
+    if 'user_id' not in session:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'})
+
+    try:
+        run_social_write(insert_superlike, session['user_id'], user_id)
+    except Exception as e:
+        print("Error sending superlike:", e)
+        return jsonify({'status': 'error', 'message': 'Failed to send request'})
     return jsonify(status='success', message='Superlike sent.')
 
 @app.route('/view_profile/<int:user_id>', methods=['GET', 'POST'])
@@ -352,12 +1722,85 @@ def view_profile(user_id):
                                 (current_user_id, user_id)).fetchone()
     contact_share_status = contact_share['status'] if contact_share else 'none'
 
-    conn.close()
     return render_template('view_profile.html', user_id=user_id, user_name=user['name'], user_age=user['age'], user_gender=user['gender'], 
                            user_location=user['location'], user_about=user['about'], user_email=user['email'] or '', 
                            user_tel=user['tel'] or '', user_instagram=user['instagram'] or '', user_telegram=user['telegram'] or '', 
                            user_photos=user_photos, photo_reveal_status=photo_reveal_status, contact_share_status=contact_share_status)
 
+# What a user answering a request of each kind is told, by table
+REQUEST_LABELS = {'photo_reveals': 'photo reveal', 'contact_shares': 'contact share'}
+
+# The statements behind requests, spelled out per table so check-query-plans sees each one
+REQUEST_SQL = {
+    'photo_reveals': {
+        'insert': '''INSERT INTO photo_reveals (requester_id, requestee_id) VALUES (?, ?)
+            ON CONFLICT (requester_id, requestee_id) DO NOTHING RETURNING id''',
+        'answer': '''UPDATE photo_reveals SET status = ?, message = ?
+            WHERE id = ? AND requestee_id = ? AND status = 'pending' RETURNING requester_id''',
+        'accept': '''INSERT INTO photo_reveals (requester_id, requestee_id, status) VALUES (?, ?, 'accepted')
+            ON CONFLICT (requester_id, requestee_id) DO UPDATE SET status = 'accepted', message = NULL''',
+        'acknowledge': "UPDATE photo_reveals SET message = 'Acknowledged' WHERE id = ? AND requester_id = ?",
+    },
+    'contact_shares': {
+        'insert': '''INSERT INTO contact_shares (requester_id, requestee_id) VALUES (?, ?)
+            ON CONFLICT (requester_id, requestee_id) DO NOTHING RETURNING id''',
+        'answer': '''UPDATE contact_shares SET status = ?, message = ?
+            WHERE id = ? AND requestee_id = ? AND status = 'pending' RETURNING requester_id''',
+        'accept': '''INSERT INTO contact_shares (requester_id, requestee_id, status) VALUES (?, ?, 'accepted')
+            ON CONFLICT (requester_id, requestee_id) DO UPDATE SET status = 'accepted', message = NULL''',
+        'acknowledge': "UPDATE contact_shares SET message = 'Acknowledged' WHERE id = ? AND requester_id = ?",
+    },
+}
+
+def insert_request(conn, table, requester_id, requestee_id):
+    # Whether the request is new; sending one again changes nothing and notifies nobody
+    created = conn.execute(REQUEST_SQL[table]['insert'], (requester_id, requestee_id)).fetchall()
+    return bool(created), [(requestee_id, None)] if created else []
+
+def insert_superlike(conn, requester_id, requestee_id):
+    photo_reveal, _ = insert_request(conn, 'photo_reveals', requester_id, requestee_id)
+    contact_share, _ = insert_request(conn, 'contact_shares', requester_id, requestee_id)
+    created = photo_reveal or contact_share
+    return created, [(requestee_id, None)] if created else []
+
+def answer_request(conn, table, request_id, user_id, user_name, status):
+    """Accept or decline a pending request sent to `user_id`; returns whether there was one.
+
+    The requester is told the answer. Accepting also grants the reverse
+    direction, replacing any request `user_id` sent the other way.
+    """
+    # Photo reveal answers name the user, contact share answers give their id
+    answered_by = user_name if table == 'photo_reveals' else user_id
+    message = f"Your {REQUEST_LABELS[table]} request to user {answered_by} has been {status}."
+    answered = conn.execute(REQUEST_SQL[table]['answer'], (status, message, request_id, user_id)).fetchall()
+    if not answered:
+        return False, []
+    requester_id = answered[0]['requester_id']
+    if status == 'accepted':
+        conn.execute(REQUEST_SQL[table]['accept'], (user_id, requester_id))
+    return True, [(requester_id, message), (user_id, None)]
+
+def acknowledge_answer(conn, table, request_id, user_id):
+    conn.execute(REQUEST_SQL[table]['acknowledge'], (request_id, user_id))
+    return None, [(user_id, None)]
+
+def handle_request(table, request_id, action):
+    if 'user_id' not in session or g.user is None:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'})
+
+    statuses = {'accept': 'accepted', 'decline': 'declined'}
+    if action not in statuses:
+        return jsonify({'status': 'error', 'message': f'Unknown action {action}'})
+    try:
+        answered = run_social_write(answer_request, table, request_id, session['user_id'], g.user['name'], statuses[action])
+    except Exception as e:
+        print(f"Error handling {REQUEST_LABELS[table]} request {action}: {e}")
+        return jsonify({'status': 'error', 'message': f'Failed to {action} request'})
+    if not answered:
+        return jsonify({'status': 'error', 'message': 'No such pending request'})
+
+    return jsonify({'status': 'success'})
+
 @app.route('/send_photo_reveal_request/<int:user_id>', methods=['POST'])
 def send_photo_reveal_request(user_id):
     if 'user_id' not in session:
@@ -365,16 +1808,12 @@ def send_photo_reveal_request(user_id):
         return jsonify({'status': 'error', 'message': 'Unauthorized'})
 
     current_user_id = session['user_id']
-    conn = get_db_connection()
     try:
-        conn.execute('INSERT INTO photo_reveals (requester_id, requestee_id) VALUES (?, ?)', (current_user_id, user_id))
-        conn.commit()
+        run_social_write(insert_request, 'photo_reveals', current_user_id, user_id)
         print("Photo reveal request sent from user_id:", current_user_id, "to user_id:", user_id)
     except Exception as e:
         print("Error sending photo reveal request:", e)
         return jsonify({'status': 'error', 'message': 'Failed to send request'})
-    finally:
-        conn.close()
 
     return jsonify({'status': 'success', 'message': 'Photo reveal request sent'})
 
@@ -385,97 +1824,36 @@ def send_contact_share_request(user_id):
         return jsonify({'status': 'error', 'message': 'Unauthorized'})
 
     current_user_id = session['user_id']
-    conn = get_db_connection()
     try:
-        conn.execute('INSERT INTO contact_shares (requester_id, requestee_id) VALUES (?, ?)', (current_user_id, user_id))
-        conn.commit()
+        run_social_write(insert_request, 'contact_shares', current_user_id, user_id)
         print("Contact share request sent from user_id:", current_user_id, "to user_id:", user_id)
     except Exception as e:
         print("Error sending contact share request:", e)
         return jsonify({'status': 'error', 'message': 'Failed to send request'})
-    finally:
-        conn.close()
 
     return jsonify({'status': 'success', 'message': 'Contact share request sent'})
 
 @app.route('/handle_photo_share_request/<int:request_id>/<action>', methods=['POST'])
 def handle_photo_share_request(request_id, action):
-    if 'user_id' not in session:
-        return jsonify({'status': 'error', 'message': 'Unauthorized'})
-
-    user_id = session['user_id']
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    user_name=user['name']
-    try:
-        if action == 'accept':
-            conn.execute('UPDATE photo_reveals SET status = ?, message = ? WHERE id = ?', ('accepted', None, request_id))
-            requester_id = conn.execute('SELECT requester_id FROM photo_reveals WHERE id = ?', (request_id,)).fetchone()['requester_id']
-            conn.execute('INSERT INTO photo_reveals (requester_id, requestee_id, status) VALUES (?, ?, ?)', (user_id, requester_id, 'accepted'))
-            message = f"Your photo reveal request to user {user_name} has been accepted."
-            conn.execute('UPDATE photo_reveals SET message = ? WHERE requester_id = ? AND requestee_id = ?', (message, requester_id, user_id))
-        elif action == 'decline':
-            conn.execute('UPDATE photo_reveals SET status = ?, message = ? WHERE id = ?', ('declined', None, request_id))
-            requester_id = conn.execute('SELECT requester_id FROM photo_reveals WHERE id = ?', (request_id,)).fetchone()['requester_id']
-            message = f"Your photo reveal request to user {user_name} has been declined."
-            conn.execute('UPDATE photo_reveals SET message = ? WHERE requester_id = ? AND requestee_id = ?', (message, requester_id, user_id))
-        conn.commit()
-    except Exception as e:
-        print(f"Error handling photo reveal request {action}: {e}")
-        return jsonify({'status': 'error', 'message': f'Failed to {action} request'})
-    finally:
-        conn.close()
-
-    return jsonify({'status': 'success'})
+    return handle_request('photo_reveals', request_id, action)
 
 @app.route('/handle_contact_share_request/<int:request_id>/<action>', methods=['POST'])
 def handle_contact_share_request(request_id, action):
-    if 'user_id' not in session:
-        return jsonify({'status': 'error', 'message': 'Unauthorized'})
-
-    user_id = session['user_id']
-    conn = get_db_connection()
-    try:
-        if action == 'accept':
-            conn.execute('UPDATE contact_shares SET status = ?, message = ? WHERE id = ?', ('accepted', None, request_id))
-            requester_id = conn.execute('SELECT requester_id FROM contact_shares WHERE id = ?', (request_id,)).fetchone()['requester_id']
-            conn.execute('INSERT INTO contact_shares (requester_id, requestee_id, status) VALUES (?, ?, ?)', (user_id, requester_id, 'accepted'))
-            message = f"Your contact share request to user {user_id} has been accepted."
-            conn.execute('UPDATE contact_shares SET message = ? WHERE requester_id = ? AND requestee_id = ?', (message, requester_id, user_id))
-        elif action == 'decline':
-            conn.execute('UPDATE contact_shares SET status = ?, message = ? WHERE id = ?', ('declined', None, request_id))
-            requester_id = conn.execute('SELECT requester_id FROM contact_shares WHERE id = ?', (request_id,)).fetchone()['requester_id']
-            message = f"Your contact share request to user {user_id} has been declined."
-            conn.execute('UPDATE contact_shares SET message = ? WHERE requester_id = ? AND requestee_id = ?', (message, requester_id, user_id))
-        conn.commit()
-    except Exception as e:
-        print(f"Error handling contact share request {action}: {e}")
-        return jsonify({'status': 'error', 'message': f'Failed to {action} request'})
-    finally:
-        conn.close()
-
-    return jsonify({'status': 'success'})
+    return handle_request('contact_shares', request_id, action)
 
 @app.route('/acknowledge_notification/<int:notification_id>/<string:notification_type>', methods=['POST'])
 def acknowledge_notification(notification_id, notification_type):
     if 'user_id' not in session:
         return jsonify(status='error', message='Unauthorized'), 401
 
-    user_id = session['user_id']
-    conn = get_db_connection()
-    
-    # Attempt to update the notification message to "Acknowledged"
+    tables = {'photo': 'photo_reveals', 'contact': 'contact_shares'}
+    if notification_type not in tables:
+        return jsonify(status='error', message=f'Unknown notification type {notification_type}'), 400
     try:
-        if notification_type == 'photo':
-            conn.execute('UPDATE photo_reveals SET message = "Acknowledged" WHERE id = ? AND requester_id = ?', (notification_id, user_id))
-        elif notification_type == 'contact':
-            conn.execute('UPDATE contact_shares SET message = "Acknowledged" WHERE id = ? AND requester_id = ?', (notification_id, user_id))
-        conn.commit()
+        run_social_write(acknowledge_answer, tables[notification_type], notification_id, session['user_id'])
     except Exception as e:
-        conn.close()
         return jsonify(status='error', message=str(e)), 500
     
-    conn.close()
     return jsonify(status='success')
 
 @app.route('/notification_count')
@@ -483,16 +1861,7 @@ def notification_count():
     if 'user_id' not in session:
         return jsonify(count=0)
 
-    user_id = session['user_id']
-    conn = get_db_connection()
-    photo_reveal_count = conn.execute('SELECT COUNT(*) FROM photo_reveals WHERE requestee_id = ? AND status = "pending"', (user_id,)).fetchone()[0]
-    contact_share_count = conn.execute('SELECT COUNT(*) FROM contact_shares WHERE requestee_id = ? AND status = "pending"', (user_id,)).fetchone()[0]
-    photo_reveal_sent_count = conn.execute('SELECT COUNT(*) FROM photo_reveals WHERE requester_id = ? AND status <> "pending" AND message != "Acknowledged"', (user_id,)).fetchone()[0]
-    contact_share_sent_count = conn.execute('SELECT COUNT(*) FROM contact_shares WHERE requester_id = ? AND status <> "pending" AND message != "Acknowledged"', (user_id,)).fetchone()[0]
-    conn.close()
-    
-    total_count = photo_reveal_count + contact_share_count + photo_reveal_sent_count + contact_share_sent_count
-    return jsonify(count=total_count)
+    return jsonify(count=read_notification_count(get_db_connection(), session['user_id']))
 
 @app.route('/notifications')
 def notifications():
@@ -503,7 +1872,7 @@ def notifications():
     conn = get_db_connection()
     # Get photo reveal requests sent to the current user
     photo_reveals = conn.execute('''
-        SELECT photo_reveals.requester_id, users.username, users.name, photo_reveals.status 
+        SELECT photo_reveals.id, photo_reveals.requester_id, users.username, users.name, photo_reveals.status 
         FROM photo_reveals 
         JOIN users ON photo_reveals.requester_id = users.id 
         WHERE photo_reveals.requestee_id = ? AND photo_reveals.status = 'pending'
@@ -511,7 +1880,7 @@ def notifications():
 
     # Get contact share requests sent to the current user
     contact_shares = conn.execute('''
-        SELECT contact_shares.requester_id, users.username, users.name, contact_shares.status 
+        SELECT contact_shares.id, contact_shares.requester_id, users.username, users.name, contact_shares.status 
         FROM contact_shares 
         JOIN users ON contact_shares.requester_id = users.id 
         WHERE contact_shares.requestee_id = ? AND contact_shares.status = 'pending'
@@ -521,7 +1890,6 @@ def notifications():
     contact_share_notifications = conn.execute('SELECT message, id, "contact" as type FROM contact_shares WHERE requester_id = ? AND message IS NOT NULL AND message != "Acknowledged" ORDER BY id DESC', (user_id,)).fetchall()
     notifications = photo_reveal_notifications + contact_share_notifications
     notifications.sort(key=lambda x: x['id'], reverse=True)
-    conn.close()
     return render_template('notifications.html', notifications=notifications, photo_reveals=photo_reveals, contact_shares=contact_shares)
 
 @app.route('/contact', methods=['GET', 'POST'])
@@ -535,18 +1903,51 @@ def contact():
         conn.execute('INSERT INTO contact_messages (name, email, message) VALUES (?, ?, ?)', 
                      (name, email, message))
         conn.commit()
-        conn.close()
 
         return render_template('contact.html', success=True)
     return render_template('contact.html')
 
 @app.route('/ai_suggestions')
 def ai_suggestions():
-    return render_template('ai_suggestions.html', matches=g.matches, user=g.user)
+    matches, last = match_page(limit=app.config['API_PAGE_SIZE'])
+    return render_template('ai_suggestions.html', matches=matches, next_cursor=last and encode_cursor(last), user=g.user)
 
 @app.route('/matches')
 def matches():
-    return render_template('matches.html', matches=g.matches, user=g.user)
+    matches, last = match_page(limit=app.config['API_PAGE_SIZE'])
+    return render_template('matches.html', matches=matches, next_cursor=last and encode_cursor(last), user=g.user)
+
+@app.route('/api/matches')
+def api_matches():
+    if not g.user:
+        return jsonify(status='error', message='Unauthorized'), 401
+
+    after = decode_cursor(request.args.get('cursor'))
+    if after is not None and not (isinstance(after, list) and len(after) == 2 and all(isinstance(value, (int, float)) for value in after)):
+        abort(400)
+    matches, last = match_page(after, page_size())
+    return jsonify(items=[api_card(match) for match in matches], next_cursor=last and encode_cursor(last))
+
+@app.route('/api/saved')
+def api_saved():
+    if not g.user:
+        return jsonify(status='error', message='Unauthorized'), 401
+
+    after = decode_cursor(request.args.get('cursor'))
+    if after is not None and not isinstance(after, int):
+        abort(400)
+    users, last = saved_page(after, page_size())
+    return jsonify(items=[api_card(user) for user in users], next_cursor=last and encode_cursor(last))
+
+@app.route('/api/search/profiles')
+def api_search_profiles():
+    if not g.user:
+        return jsonify(status='error', message='Unauthorized'), 401
+
+    user_ids, last = search_page('users', request.args.get('q'), search_cursor(), page_size())
+    cards = load_profile_cards(get_db_connection(), g.user['id'], user_ids)
+    items = [api_card(cards[user_id]) for user_id in user_ids if user_id in cards and user_id != g.user['id']]
+    return jsonify(items=items, next_cursor=last and encode_cursor(last))
 
 @app.route('/settings')
 def settings():
@@ -562,10 +1963,263 @@ def privacy():
 
 @app.route('/admin/contact_messages')
 def view_contact_messages():
+    # Newest first, or best match first when searching
+    conn = get_db_connection()
+    text = request.args.get('q', '').strip()
+    limit = app.config['ADMIN_PAGE_SIZE']
+    if text:
+        message_ids, last = search_page('contact_messages', text, search_cursor(), limit)
+        messages = contact_message_rows(conn, message_ids)
+    else:
+        before = decode_cursor(request.args.get('cursor'))
+        if before is not None and not isinstance(before, int):
+            abort(400)
+        messages = conn.execute('SELECT id, name, email, message FROM contact_messages WHERE id < ? ORDER BY id DESC LIMIT ?',
+                                (before or 2 ** 63 - 1, limit + 1)).fetchall()
+        last = messages[limit - 1]['id'] if len(messages) > limit else None
+        messages = messages[:limit]
+    return render_template('admin_contact_messages.html', messages=messages, query=text, next_cursor=last and encode_cursor(last))
+
+@app.route('/admin/search/contact_messages')
+def api_search_contact_messages():
+    # Names, emails and messages from the contact form: only for the configured admins
+    if not g.user:
+        return jsonify(status='error', message='Unauthorized'), 401
+    if g.user['id'] not in app.config['ADMIN_USER_IDS']:
+        return jsonify(status='error', message='Forbidden'), 403
+
+    message_ids, last = search_page('contact_messages', request.args.get('q'), search_cursor(), page_size())
+    messages = contact_message_rows(get_db_connection(), message_ids)
+    return jsonify(items=[dict(message) for message in messages], next_cursor=last and encode_cursor(last))
+
+@app.route('/admin/lazy_usage')
+def view_lazy_usage():
+    with lazy_usage_lock:
+        return jsonify(lazy_usage)
+
+@app.route('/admin/metrics')
+def view_metrics():
+    body = '\n'.join(histogram.render() for histogram in request_histograms.values()) + '\n'
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/fragment_cache')
+def view_fragment_cache():
+    return jsonify(fragment_cache.stats())
+
+@app.route('/admin/write_queue')
+def view_write_queue():
+    return jsonify(social_writes.stats())
+
+@app.route('/admin/match_index')
+def view_match_index():
+    stats = {'engine': app.config['MATCH_ENGINE'], 'shared': shared_match_index, 'generation': match_index_state['generation']}
+    if shared_match_index and match_index.segment is not None:
+        segment = match_index.segment
+        stats.update(segment=segment.name, segment_generation=segment.generation, segment_bytes=segment.nbytes,
+                     segment_users=segment.users, segment_terms=segment.terms, overlay_users=match_index.overlay_size)
+    return jsonify(stats)
+
+def orphan_uploads_job(conn):
+    """Delete upload files and thumbnails that no photos row references.
+
+    Left behind by deletes from before files were released with their rows,
+    and by uploads whose process died before recording them. Files younger
+    than ORPHAN_UPLOAD_GRACE are skipped, as an upload in progress may not
+    have its row yet. A file is only removed after checking again under the
+    write lock, as release_photos() does.
+
+    The folder is only collected for the database that owns it. A folder
+    without an owner file is claimed by the first database that references
+    a file in it. Other databases pointed at the same folder, such as a
+    benchmark's synthetic one, reference none of its files and must not
+    treat them as orphans. After moving the database, delete the owner file
+    so the folder can be claimed again.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    cutoff = time.time() - app.config['ORPHAN_UPLOAD_GRACE']
+    if not os.path.isdir(folder):
+        return
+    owner = upload_folder_owner()
+    recorded = photos.folder_owner(folder)
+    if recorded is None and any(conn.execute('SELECT 1 FROM photos WHERE filename = ? LIMIT 1', (name,)).fetchone()
+                                for name in os.listdir(folder)):
+        recorded = photos.claim_folder(folder, owner)
+    if recorded != owner:
+        raise RuntimeError(f'{folder} is not owned by database {app.config["DATABASE"]}; not removing its files')
+    thumbs = os.path.join(folder, photos.THUMBS_FOLDER)
+    # (directory, name of the upload a file belongs to)
+    directories = [(folder, lambda name: name), (thumbs, lambda name: os.path.splitext(name)[0])]
+    for directory, upload_of in directories:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not os.path.isfile(path) or stat.st_mtime > cutoff or name == photos.OWNER_FILE:
+                yield 0, 0
+                continue
+            # Temporaries of an upload or variant that never got its final name
+            if name.startswith(('.upload-', '.variant-')):
+                removed = remove_orphan(path)
+                yield removed, removed * stat.st_size
+                continue
+            if conn.execute('SELECT 1 FROM photos WHERE filename = ? LIMIT 1', (upload_of(name),)).fetchone():
+                yield 0, 0
+                continue
+            begin_write(conn)
+            try:
+                removed = 0
+                if not conn.execute('SELECT 1 FROM photos WHERE filename = ? LIMIT 1', (upload_of(name),)).fetchone():
+                    removed = remove_orphan(path)
+            finally:
+                conn.commit()
+            yield removed, removed * stat.st_size
+
+def upload_folder_owner():
+    # How this database is named in the upload folder's owner file; a digest, as the folder is served
+    return hashlib.sha256(os.path.realpath(app.config['DATABASE']).encode()).hexdigest()
+
+def remove_orphan(path):
+    # 1 when the file was removed, 0 when something else got to it first
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return 1
+
+# (table, columns holding user ids) of rows that mean nothing once any of those users is gone
+USER_ROWS = [
+    ('saved_profiles', ('user_id', 'profile_id')),
+    ('photo_reveals', ('requester_id', 'requestee_id')),
+    ('contact_shares', ('requester_id', 'requestee_id')),
+    ('notification_counters', ('user_id',)),
+    ('photos', ('user_id',)),
+]
+
+def dangling_rows_job(conn, batch=500):
+    # Walks each table by rowid, a batch per transaction; photos removed here release their files
+    for table, columns in USER_ROWS:
+        dangling = ' OR '.join(f'NOT EXISTS (SELECT 1 FROM users WHERE users.id = {table}.{column})' for column in columns)
+        returning = 'filename' if table == 'photos' else 'rowid'
+        after = 0
+        while True:
+            last = conn.execute(f'SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)',
+                                (after, batch)).fetchone()[0]
+            if last is None:
+                break
+            begin_write(conn)
+            try:
+                deleted = conn.execute(f'DELETE FROM {table} WHERE rowid > ? AND rowid <= ? AND ({dangling}) RETURNING {returning}',
+                                       (after, last)).fetchall()
+                if table == 'photos':
+                    release_photos(conn, [row['filename'] for row in deleted])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            after = last
+            yield len(deleted), 0
+
+def analyze_job(conn):
+    # Planner statistics, one table per step; analysis_limit samples each index instead of reading it whole
+    conn.execute('PRAGMA analysis_limit = 1000')
+    tables = [row['tbl_name'] for row in conn.execute("SELECT DISTINCT tbl_name FROM sqlite_schema WHERE type = 'index'")]
+    for table in tables:
+        retry_on_locked(lambda: conn.execute('ANALYZE "%s"' % table))
+        yield 0, 0
+
+def incremental_vacuum_job(conn, pages=256):
+    # Returns free pages to the file system a few at a time; needs auto_vacuum = INCREMENTAL
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    while free:
+        # The pragma frees pages one row at a time, so it has to be stepped to the end
+        retry_on_locked(lambda: conn.execute('PRAGMA incremental_vacuum(%d)' % pages).fetchall())
+        left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if left >= free:
+            return
+        yield free - left, (free - left) * page_size
+        free = left
+
+def claim_maintenance_job(conn, name, interval):
+    # Moves the job's start time forward only when its last run is due, so one process runs it
+    now = time.time()
+    begin_write(conn)
+    try:
+        claimed = conn.execute('''
+            INSERT INTO maintenance_runs (job, started) VALUES (?, ?)
+            ON CONFLICT (job) DO UPDATE SET started = excluded.started WHERE maintenance_runs.started <= ?
+            RETURNING job
+        ''', (name, now, now - interval)).fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return claimed is not None
+
+def record_maintenance_run(conn, name, report):
+    begin_write(conn)
+    try:
+        conn.execute('''
+            INSERT INTO maintenance_runs (job, started, seconds, elapsed, slices, removed, bytes_reclaimed, error)
+            VALUES (:job, :started, :seconds, :elapsed, :slices, :removed, :bytes_reclaimed, :error)
+            ON CONFLICT (job) DO UPDATE SET started = excluded.started, seconds = excluded.seconds, elapsed = excluded.elapsed,
+                slices = excluded.slices, removed = excluded.removed, bytes_reclaimed = excluded.bytes_reclaimed, error = excluded.error
+        ''', dict(report, job=name))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+maintenance = MaintenanceScheduler(connect_db, claim_maintenance_job, record_maintenance_run, app.config['MAINTENANCE_SLICE_SECONDS'],
+                                   app.config['MAINTENANCE_PAUSE_SECONDS'], app.config['MAINTENANCE_CHECK_SECONDS'])
+for name, job in [('orphan_uploads', orphan_uploads_job), ('dangling_rows', dangling_rows_job),
+                  ('analyze', analyze_job), ('incremental_vacuum', incremental_vacuum_job)]:
+    maintenance.add(name, job, app.config['MAINTENANCE_INTERVALS'][name])
+
+@app.route('/admin/maintenance')
+def view_maintenance():
     conn = get_db_connection()
-    messages = conn.execute('SELECT * FROM contact_messages').fetchall()
-    conn.close()
-    return render_template('admin_contact_messages.html', messages=messages)
+    runs = {row['job']: dict(row) for row in conn.execute('SELECT * FROM maintenance_runs')}
+    jobs = {}
+    for name, (_, interval) in maintenance.jobs.items():
+        run = runs.get(name, {})
+        jobs[name] = dict(run, interval=interval, due=run['started'] + interval if run else None)
+        jobs[name].pop('job', None)
+    database = {pragma: conn.execute('PRAGMA %s' % pragma).fetchone()[0] for pragma in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')}
+    return jsonify(jobs=jobs, database=database)
+
+@app.cli.command('run-maintenance')
+@click.argument('jobs', nargs=-1)
+@click.option('--pause', default=0.0, show_default=True, type=float, help='Seconds between slices.')
+def run_maintenance_command(jobs, pause):
+    """Run maintenance jobs now, all of them by default, and print what they reclaimed."""
+    unknown = set(jobs) - set(maintenance.jobs)
+    if unknown:
+        raise click.ClickException(f"Unknown job(s): {', '.join(sorted(unknown))}; known: {', '.join(maintenance.jobs)}")
+    conn = get_db_connection()
+    for name in jobs or maintenance.jobs:
+        report = maintenance.run_job(name, conn, pause)
+        click.echo(f"{name}: removed {report['removed']}, reclaimed {report['bytes_reclaimed']} bytes "
+                   f"in {report['seconds']:.2f} s ({report['slices']} slices)" + (f", failed: {report['error']}" if report['error'] else ''))
+
+@app.cli.command('vacuum-db')
+def vacuum_db_command():
+    """Rebuild the database with incremental auto-vacuum, so maintenance can give free pages back.
+
+    VACUUM rewrites the whole file and holds the write lock meanwhile; run it while the app is stopped.
+    """
+    conn = get_db_connection()
+    conn.commit()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    click.echo(f"auto_vacuum = {conn.execute('PRAGMA auto_vacuum').fetchone()[0]}, "
+               f"{conn.execute('PRAGMA page_count').fetchone()[0]} pages")
 
 @app.route('/delete_data', methods=['POST'])
 def delete_data():
@@ -576,12 +2230,16 @@ def delete_data():
     conn = get_db_connection()
 
     try:
-        # Delete user's photos
+        # Delete user's photos; their files are released below once nothing references them
+        filenames = [row['filename'] for row in conn.execute('SELECT filename FROM photos WHERE user_id = ?', (user_id,))]
         conn.execute('DELETE FROM photos WHERE user_id = ?', (user_id,))
         
         # Delete user's contact messages
         conn.execute('DELETE FROM contact_messages WHERE email = (SELECT email FROM users WHERE id = ?)', (user_id,))
         
+        # Delete profiles the user saved, and their place in others' saved profiles
+        conn.execute('DELETE FROM saved_profiles WHERE user_id = ? OR profile_id = ?', (user_id, user_id))
+
         # Delete user's notifications
         conn.execute('DELETE FROM photo_reveals WHERE requester_id = ? OR requestee_id = ?', (user_id, user_id))
         conn.execute('DELETE FROM contact_shares WHERE requester_id = ? OR requestee_id = ?', (user_id, user_id))
@@ -589,14 +2247,17 @@ def delete_data():
         # Delete user's profile
         conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
 
+        release_photos(conn, filenames)
         conn.commit()
-        conn.close()
+        match_index.remove(user_id)
+        # Lists the user appeared in are marked for recomputing by a trigger
+        queue_match_refresh()
 
         # Log the user out after deletion
         session.pop('user_id', None)
         return redirect(url_for('login'))
     except Exception as e:
-        conn.close()
+        conn.rollback()
         return jsonify(status='error', message=str(e)), 500
     
 @app.route('/contact_faqs')
@@ -605,6 +2266,19 @@ def contact_faqs():
         return redirect(url_for('login'))
     return render_template('contact_faqs.html')
 
+with app.app_context():
+    migrate_db(get_db_connection())
+    build_match_index()
+    queue_missing_photo_variants()
+    # Matches left marked dirty by a previous run
+    queue_match_refresh()
+    asset_manifest.precompress(skip=('uploads',))
+
+if app.config['MAINTENANCE_CHECK_SECONDS']:
+    maintenance.start()
+
+if app.config['NOTIFICATION_STREAM_PORT']:
+    create_notification_stream(port=app.config['NOTIFICATION_STREAM_PORT']).start()
 
 if __name__ == '__main__':
     app.run(debug=True)
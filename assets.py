@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map', '.xml', '.ico'}
+# Uploads are stored under their sha256, which already makes a fine version
+CONTENT_ADDRESSED = re.compile(r'^([0-9a-f]{64})\.[a-z0-9]+$')
+VERSION_LENGTH = 16
+CHUNK_SIZE = 64 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Asset:
+    def __init__(self, path, version, mtime_ns, size, variants):
+        self.path = path
+        self.version = version
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.variants = variants
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    def negotiate(self, accept_encodings):
+        """Return (content encoding or None, path) of the best representation the client accepts."""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding, self.variants[encoding]
+        return None, self.path
+
+    def etag(self, encoding=None):
+        # Strong ETags have to differ between encodings of the same content
+        return '%s-%s' % (self.version, encoding) if encoding else self.version
+
+
+class AssetManifest:
+    """Content hashes and precompressed variants of the files under a static folder.
+
+    A file is hashed the first time it is asked for and again only when its
+    mtime or size changes, so versions stay current while assets are edited
+    without any build step. Text assets get gzip (and, with the brotli
+    package, br) variants in `cache_folder`, named after their hash.
+    """
+
+    def __init__(self, static_folder, cache_folder):
+        self.static_folder = static_folder
+        self.cache_folder = cache_folder
+        self._assets = {}
+
+    def version(self, filename):
+        match = CONTENT_ADDRESSED.match(os.path.basename(filename))
+        if match:
+            return match.group(1)[:VERSION_LENGTH]
+        asset = self.asset(filename)
+        return asset.version if asset else None
+
+    def asset(self, filename):
+        path = safe_join(self.static_folder, filename)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        asset = self._assets.get(path)
+        if asset is None or (asset.mtime_ns, asset.size) != (stat.st_mtime_ns, stat.st_size):
+            asset = self._assets[path] = self._load(path, stat, asset)
+        return asset
+
+    def precompress(self, skip=()):
+        """Hash and compress every text asset up front, except under the `skip` subfolders."""
+        for root, folders, files in os.walk(self.static_folder):
+            if root == self.static_folder:
+                folders[:] = [folder for folder in folders if folder not in skip]
+            for name in files:
+                if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                    self.asset(os.path.relpath(os.path.join(root, name), self.static_folder))
+
+    def _load(self, path, stat, previous):
+        version = file_digest(path)[:VERSION_LENGTH]
+        variants = {}
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE:
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = self._compress(path, version, data)
+        if previous is not None and previous.version != version:
+            for variant in previous.variants.values():
+                if os.path.exists(variant):
+                    os.remove(variant)
+        return Asset(path, version, stat.st_mtime_ns, stat.st_size, variants)
+
+    def _compress(self, path, version, data):
+        variants = {}
+        base = os.path.join(self.cache_folder, os.path.relpath(path, self.static_folder))
+        compressors = [('gzip', '.gz', lambda: gzip.compress(data, 9, mtime=0))]
+        if brotli is not None:
+            compressors.append(('br', '.br', lambda: brotli.compress(data, quality=11)))
+        for encoding, suffix, compress in compressors:
+            variant = '%s.%s%s' % (base, version, suffix)
+            if not os.path.exists(variant):
+                compressed = compress()
+                # Not worth a Content-Encoding for files that barely shrink
+                if len(compressed) >= len(data) * 0.9:
+                    continue
+                os.makedirs(os.path.dirname(variant), exist_ok=True)
+                fd, temporary = tempfile.mkstemp(dir=os.path.dirname(variant), prefix='.compress-')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(compressed)
+                os.replace(temporary, variant)
+            variants[encoding] = variant
+        return variants
@@ -0,0 +1,88 @@
+"""Compare match latency with and without the spatial pre-filter.
+
+Fills a throwaway database with users spread over a handful of cities and
+times the full match list (match_page()) for a sample of them, first scoring every user, then
+only those within MATCH_RADIUS_KM, then only the MATCH_NEAREST nearest.
+
+    python benchmarks/bench_geo.py --users 20000 --radius 25 --nearest 500
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CITIES = [
+    ('Berlin', 52.52, 13.405), ('Hamburg', 53.551, 9.993), ('Munich', 48.137, 11.575),
+    ('Frankfurt', 50.110, 8.682), ('Cologne', 50.937, 6.960), ('Vienna', 48.208, 16.373),
+    ('Zurich', 47.376, 8.541), ('Paris', 48.856, 2.352), ('Amsterdam', 52.370, 4.895),
+    ('Prague', 50.075, 14.437),
+]
+WORDS = ('love music travel hiking books coffee yoga meditate family cooking dogs cats art movies '
+         'running beach mountains dance friends wine tea photography science history poetry').split()
+
+
+def populate(database, count, seed):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(database)
+    rows = []
+    for i in range(count):
+        city, latitude, longitude = rng.choice(CITIES)
+        rows.append((f'user{i}', '-', ' '.join(rng.choices(WORDS, k=rng.randint(5, 40))), f'User {i}',
+                     rng.randint(18, 60), city, latitude + rng.gauss(0, 0.15), longitude + rng.gauss(0, 0.2)))
+    conn.executemany('INSERT INTO users (username, password, about, name, age, location, latitude, longitude) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def time_matches(app_module, user_ids, radius_km, nearest):
+    app_module.app.config['MATCH_RADIUS_KM'] = radius_km
+    app_module.app.config['MATCH_NEAREST'] = nearest
+    timings = []
+    sizes = []
+    for user_id in user_ids:
+        with app_module.app.test_request_context('/matches'):
+            app_module.session['user_id'] = user_id
+            app_module.app.preprocess_request()
+            started = time.perf_counter()
+            matches, _ = app_module.match_page()
+            timings.append((time.perf_counter() - started) * 1000)
+            sizes.append(len(matches))
+    return timings, sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--radius', type=float, default=25.0, help='radius in km')
+    parser.add_argument('--nearest', type=int, default=500, help='nearest users to score')
+    parser.add_argument('--samples', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['RELATIKA_DATABASE'] = database
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app as app_module
+
+    populate(database, args.users, args.seed)
+    with app_module.app.app_context():
+        app_module.build_match_index()
+    user_ids = random.Random(args.seed).sample(range(1, args.users + 1), args.samples)
+
+    print(f'{args.users} users, {args.samples} samples')
+    modes = [('unfiltered', None, None), (f'within {args.radius:g} km', args.radius, None), (f'nearest {args.nearest}', None, args.nearest)]
+    for label, radius_km, nearest in modes:
+        timings, sizes = time_matches(app_module, user_ids, radius_km, nearest)
+        timings.sort()
+        print(f'{label:>16}: candidates {statistics.mean(sizes):9.0f}  '
+              f'p50 {statistics.median(timings):8.1f} ms  p95 {timings[int(len(timings) * 0.95) - 1]:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Login throughput, and the latency of other routes, during a login storm.
+
+Serves the app over HTTP from a fixed pool of request threads, like a
+threaded production server, on a database from benchmarks/dataset.py.
+--clients threads then post valid logins back to back for --duration
+seconds while a probe requests a page that needs no password work every
+--probe-interval seconds. A client turned away with 503 waits --backoff
+seconds before trying again. The storm runs twice: with the configured queue
+limit on password hashing, and with the limit lifted so that every login
+waits its turn, as when hashes were computed on the request thread.
+
+    python benchmarks/bench_login.py --users 1000 --clients 32 --workers 8
+"""
+import argparse
+import http.client
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlencode
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI server handling requests on a fixed number of threads."""
+
+    def __init__(self, address, app, workers):
+        super().__init__(address, QuietHandler)
+        self.set_app(app)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bench-server')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.handle_in_pool, request, client_address)
+
+    def handle_in_pool(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def timed_request(port, method, path, body=None):
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    started = time.perf_counter()
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    response.read()
+    elapsed = (time.perf_counter() - started) * 1000
+    connection.close()
+    return response.status, elapsed
+
+
+def storm(port, usernames, password, clients, duration, backoff, probe_path, probe_interval):
+    """Run one login storm; returns (login outcomes, probe timings in ms)."""
+    deadline = time.perf_counter() + duration
+    outcomes = []  # (status, ms)
+    probes = []
+    lock = threading.Lock()
+
+    def log_in(client):
+        number = client
+        while time.perf_counter() < deadline:
+            username = usernames[number % len(usernames)]
+            number += clients
+            result = timed_request(port, 'POST', '/login', urlencode({'username': username, 'password': password}))
+            with lock:
+                outcomes.append(result)
+            if result[0] == 503:
+                time.sleep(backoff)
+
+    def probe():
+        while time.perf_counter() < deadline:
+            status, elapsed = timed_request(port, 'GET', probe_path)
+            if status != 200:
+                raise SystemExit(f'GET {probe_path} failed with {status}')
+            probes.append(elapsed)
+            time.sleep(probe_interval)
+
+    threads = [threading.Thread(target=log_in, args=(client,)) for client in range(clients)]
+    threads.append(threading.Thread(target=probe))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes, probes
+
+
+def report(label, outcomes, probes, duration):
+    signed_in = sorted(ms for status, ms in outcomes if status == 302)
+    rejected = sorted(ms for status, ms in outcomes if status == 503)
+    failed = len(outcomes) - len(signed_in) - len(rejected)
+    probes = sorted(probes)
+    print(f'\n{label}')
+    print(f'  logins      {len(signed_in) / duration:7.1f} /s   p50 {statistics.median(signed_in) if signed_in else 0:7.1f} ms'
+          f'   p95 {percentile(signed_in, 0.95) if signed_in else 0:7.1f} ms')
+    print(f'  rejected    {len(rejected) / duration:7.1f} /s   p50 {statistics.median(rejected) if rejected else 0:7.1f} ms'
+          + (f'   ({failed} other failures)' if failed else ''))
+    print(f'  probe       {len(probes):7d} req  p50 {statistics.median(probes):7.1f} ms   p95 {percentile(probes, 0.95):7.1f} ms'
+          f'   p99 {percentile(probes, 0.99):7.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=32, help='concurrent login clients')
+    parser.add_argument('--workers', type=int, default=8, help='server request threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per storm')
+    parser.add_argument('--backoff', type=float, default=0.5, help='seconds a rejected client waits')
+    parser.add_argument('--probe', default='/terms', help='route timed during the storm')
+    parser.add_argument('--probe-interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['RELATIKA_DATABASE'] = database
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app as app_module
+    from dataset import PASSWORD, populate
+    from passwords import PasswordHasher
+
+    populate(database, args.users, args.seed)
+    conn = app_module.connect_db()
+    usernames = [row['username'] for row in conn.execute('SELECT username FROM users')]
+    conn.close()
+
+    server = PooledWSGIServer(('127.0.0.1', 0), app_module.app, args.workers)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = app_module.app.config
+    # (label, queue limit, timeout)
+    modes = [
+        (f'queue limit {config["PASSWORD_QUEUE_LIMIT"]}', config['PASSWORD_QUEUE_LIMIT'], config['PASSWORD_TIMEOUT']),
+        ('no queue limit (every login waits)', args.clients + args.workers, None),
+    ]
+    print(f'{args.users} users, {args.clients} login clients, {args.workers} server threads, '
+          f'{config["PASSWORD_WORKERS"]} hashing threads, probing {args.probe}', file=sys.stderr)
+    for label, limit, timeout in modes:
+        app_module.password_hasher = PasswordHasher(config['PASSWORD_HASH_METHOD'], config['PASSWORD_WORKERS'], limit, timeout)
+        outcomes, probes = storm(port, usernames, PASSWORD, args.clients, args.duration, args.backoff,
+                                 args.probe, args.probe_interval)
+        report(label, outcomes, probes, args.duration)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
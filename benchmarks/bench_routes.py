@@ -0,0 +1,234 @@
+"""Route-level latency and query counts, compared against a JSON baseline.
+
+Generates a database with benchmarks/dataset.py for each population size,
+then drives the app's pages, JSON endpoints and POST actions through the
+Flask test client as randomly chosen users. Every route reports p50, p95
+and p99 latency and the SQL statements it ran per request, as counted by
+the app's own request instrumentation.
+
+    python benchmarks/bench_routes.py --users 1000 10000 100000
+    python benchmarks/bench_routes.py --users 1000 --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_routes.py --users 1000 --baseline benchmarks/baseline.json
+
+Each population size runs --runs times, every run in a fresh process, so
+caches never carry over and run-to-run variation (whether a background
+worker happened to overlap the timed requests) shows up as the spread of
+the runs. With --baseline the run exits non-zero when a route now runs
+more queries per request, or when its p95 in every run is more than
+--tolerance above the highest p95 of the baseline's runs.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def pending_request(table):
+    # Each sample answers a different pending request, addressed to the user it acts as
+    def pick(conn, rng, user_ids):
+        row = conn.execute(f"SELECT id, requestee_id FROM {table} WHERE status = 'pending' "
+                           f'ORDER BY RANDOM() LIMIT 1').fetchone()
+        return row[1], row[0]
+    return pick
+
+
+def answered_request(conn, rng, user_ids):
+    row = conn.execute("SELECT id, requester_id FROM photo_reveals WHERE status <> 'pending' "
+                       "AND message != 'Acknowledged' ORDER BY RANDOM() LIMIT 1").fetchone()
+    return row[1], row[0]
+
+
+def any_user(conn, rng, user_ids):
+    return rng.choice(user_ids), rng.choice(user_ids)
+
+
+# Common and rare words from the generated about texts, a two-word query and an unfinished word
+SEARCH_TERMS = ('hiking', 'coffee', 'salsa+dancing', 'film+photography', 'volunteer', 'chess', 'clim')
+
+
+def search_term(conn, rng, user_ids):
+    return rng.choice(user_ids), rng.choice(SEARCH_TERMS)
+
+
+# (name, method, path template, pick(conn, rng, user_ids) -> (acting user id, path argument))
+ROUTES = [
+    ('home', 'GET', '/dashboard', any_user),
+    ('browse', 'GET', '/browse', any_user),
+    ('next_random_profile', 'GET', '/next_random_profile', any_user),
+    ('view_profile', 'GET', '/view_profile/{}', any_user),
+    ('profile', 'GET', '/profile', any_user),
+    ('saved', 'GET', '/saved', any_user),
+    ('matches', 'GET', '/matches', any_user),
+    ('ai_suggestions', 'GET', '/ai_suggestions', any_user),
+    ('api_matches', 'GET', '/api/matches', any_user),
+    ('api_saved', 'GET', '/api/saved', any_user),
+    ('search_profiles', 'GET', '/api/search/profiles?q={}', search_term),
+    ('notifications', 'GET', '/notifications', any_user),
+    ('notification_count', 'GET', '/notification_count', any_user),
+    ('save_profile', 'POST', '/save_profile/{}', any_user),
+    ('send_photo_reveal_request', 'POST', '/send_photo_reveal_request/{}', any_user),
+    ('send_contact_share_request', 'POST', '/send_contact_share_request/{}', any_user),
+    ('accept_photo_reveal', 'POST', '/handle_photo_share_request/{}/accept', pending_request('photo_reveals')),
+    ('decline_contact_share', 'POST', '/handle_contact_share_request/{}/decline', pending_request('contact_shares')),
+    ('acknowledge_notification', 'POST', '/acknowledge_notification/{}/photo', answered_request),
+]
+
+
+def run_size(users, samples, seed, routes):
+    """Benchmark every route against a fresh database of `users` users; returns {route: result}."""
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['RELATIKA_DATABASE'] = database
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app as app_module
+    from dataset import populate
+
+    started = time.perf_counter()
+    user_ids = populate(database, users, seed)
+    with app_module.app.app_context():
+        app_module.build_match_index()
+    print(f'{users} users generated in {time.perf_counter() - started:.1f} s', file=sys.stderr)
+
+    # Statements charged to the request itself, not to background workers running meanwhile.
+    # Registered last, so it runs before the app's own teardown consumes the stats.
+    statements = [0]
+
+    @app_module.app.teardown_request
+    def count_statements(exc):
+        stats = app_module.g.get('request_stats')
+        statements[0] = stats.statements if stats is not None else 0
+
+    rng = random.Random(seed)
+    client = app_module.app.test_client()
+    picker = sqlite3.connect(database)
+    results = {}
+    for name, method, template, pick in routes:
+        timings = []
+        queries = []
+        for sample in range(samples + 3):
+            user_id, argument = pick(picker, rng, user_ids)
+            with client.session_transaction() as session:
+                session['user_id'] = user_id
+            started = time.perf_counter()
+            response = client.open(template.format(argument), method=method)
+            elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code >= 400:
+                raise SystemExit(f'{method} {template.format(argument)} failed with {response.status_code}')
+            # The first few requests warm the pool and caches
+            if sample >= 3:
+                timings.append(elapsed)
+                queries.append(statements[0])
+        timings.sort()
+        results[name] = {
+            'p50_ms': round(statistics.median(timings), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'queries': round(statistics.mean(queries), 2),
+        }
+    picker.close()
+    return results
+
+
+def combine(runs):
+    """Merge repeated runs of one size: median latencies, mean queries and every run's p95."""
+    combined = {}
+    for name in runs[0]:
+        results = [run[name] for run in runs]
+        combined[name] = {
+            'p50_ms': statistics.median(result['p50_ms'] for result in results),
+            'p95_ms': statistics.median(result['p95_ms'] for result in results),
+            'p99_ms': statistics.median(result['p99_ms'] for result in results),
+            'p95_runs': [result['p95_ms'] for result in results],
+            'queries': round(statistics.mean(result['queries'] for result in results), 2),
+        }
+    return combined
+
+
+def compare(results, baseline, tolerance):
+    """Return a line per route that got slower or runs more queries than in `baseline`.
+
+    A route got slower when even its fastest run's p95 is beyond the
+    slowest baseline run's, so one run disturbed by chance flags nothing.
+    """
+    regressions = []
+    for users, routes in results.items():
+        for name, result in routes.items():
+            before = baseline.get(users, {}).get(name)
+            if before is None:
+                continue
+            fastest = min(result.get('p95_runs', [result['p95_ms']]))
+            slowest_before = max(before.get('p95_runs', [before['p95_ms']]))
+            if fastest > slowest_before * (1 + tolerance):
+                regressions.append(f'{users} users, {name}: p95 {slowest_before:.1f} -> {fastest:.1f} ms in every run')
+            if result['queries'] > before['queries']:
+                regressions.append(f'{users} users, {name}: queries {before["queries"]:g} -> {result["queries"]:g}')
+    return regressions
+
+
+def print_results(results):
+    for users, routes in results.items():
+        print(f'\n{users} users')
+        print(f'{"route":>28} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8}')
+        for name, result in routes.items():
+            print(f'{name:>28} {result["p50_ms"]:9.1f} {result["p95_ms"]:9.1f} {result["p99_ms"]:9.1f} {result["queries"]:8g}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--samples', type=int, default=50, help='timed requests per route')
+    parser.add_argument('--runs', type=int, default=3, help='runs per population size, each in a fresh process')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--routes', nargs='+', help='only these routes')
+    parser.add_argument('--baseline', help='JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 growth (0.25 = 25%%)')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--json', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    routes = [route for route in ROUTES if not args.routes or route[0] in args.routes]
+    if args.json:
+        # Child process for one size; the app prints to stdout, so results go to a file
+        results = run_size(args.users[0], args.samples, args.seed, routes)
+        with open(args.json, 'w') as f:
+            json.dump(results, f)
+        return
+
+    results = {}
+    output = os.path.join(tempfile.mkdtemp(), 'results.json')
+    for users in args.users:
+        command = [sys.executable, __file__, '--json', output, '--users', str(users), '--samples', str(args.samples),
+                   '--seed', str(args.seed)] + (['--routes'] + args.routes if args.routes else [])
+        runs = []
+        for _ in range(args.runs):
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            with open(output) as f:
+                runs.append(json.load(f))
+        results[str(users)] = combine(runs)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
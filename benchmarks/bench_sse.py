@@ -0,0 +1,142 @@
+"""Measure fan-out latency of the notification event stream.
+
+Starts the asyncio stream server against a throwaway database, opens one
+idle SSE connection per simulated user, then repeatedly publishes an event
+to every user and records how long each takes to arrive. With --outbox the
+events are written to the notification_events table from a separate
+connection instead, as another worker process would, and reach the clients
+through the server's relay.
+
+    python benchmarks/bench_sse.py --clients 2000 --rounds 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Client:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.received = {}
+
+    async def connect(self, port, cookie):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.writer.write(('GET /notifications/stream HTTP/1.1\r\nHost: localhost\r\nCookie: session=%s\r\n\r\n'
+                           % cookie).encode('latin-1'))
+        await self.writer.drain()
+        status = await self.reader.readline()
+        if b' 200 ' not in status:
+            raise RuntimeError('stream refused: %r' % status)
+        await self.next_event()
+
+    async def next_event(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('stream closed')
+            if line.startswith(b'data: '):
+                return json.loads(line[6:])
+
+    async def listen(self, round_started, arrived):
+        while True:
+            event = await self.next_event()
+            self.received[event['count']] = time.perf_counter() - round_started[event['count']]
+            arrived(event['count'])
+
+
+def publish_direct(app_module, user_ids, round_number):
+    for user_id in user_ids:
+        app_module.notification_broker.publish(user_id, {'count': round_number, 'message': None})
+
+
+def publish_outbox(conn, user_ids, round_number):
+    with conn:
+        conn.executemany('INSERT INTO notification_counters (user_id, count) VALUES (?, ?) '
+                         'ON CONFLICT (user_id) DO UPDATE SET count = excluded.count',
+                         [(user_id, round_number) for user_id in user_ids])
+        conn.executemany('INSERT INTO notification_events (user_id, message, origin) VALUES (?, NULL, -1)',
+                         [(user_id,) for user_id in user_ids])
+
+
+async def run(app_module, args):
+    server = app_module.create_notification_stream(port=0).start()
+    serializer = app_module.app.session_interface.get_signing_serializer(app_module.app)
+    clients = [Client(user_id) for user_id in range(1, args.clients + 1)]
+    loop = asyncio.get_running_loop()
+
+    started = time.perf_counter()
+    for batch in range(0, len(clients), 200):
+        await asyncio.gather(*(client.connect(server.port, serializer.dumps({'user_id': client.user_id}))
+                               for client in clients[batch:batch + 200]))
+    print(f'{len(clients)} connections in {time.perf_counter() - started:.2f} s, '
+          f'{threading.active_count()} threads in this process')
+
+    round_started = {}
+    pending = {}
+    done = {}
+
+    def arrived(round_number):
+        pending[round_number] -= 1
+        if not pending[round_number]:
+            done[round_number].set()
+
+    listeners = [asyncio.create_task(client.listen(round_started, arrived)) for client in clients]
+    user_ids = [client.user_id for client in clients]
+    outbox = sqlite3.connect(app_module.app.config['DATABASE'], check_same_thread=False) if args.outbox else None
+    completions = []
+    for round_number in range(1, args.rounds + 1):
+        pending[round_number] = len(clients)
+        done[round_number] = asyncio.Event()
+        round_started[round_number] = time.perf_counter()
+        if outbox is not None:
+            await loop.run_in_executor(None, publish_outbox, outbox, user_ids, round_number)
+        else:
+            # Publish from another thread, as a request handler would
+            await loop.run_in_executor(None, publish_direct, app_module, user_ids, round_number)
+        await asyncio.wait_for(done[round_number].wait(), 60)
+        completions.append(time.perf_counter() - round_started[round_number])
+        await asyncio.sleep(args.pause)
+
+    latencies = sorted(latency * 1000 for client in clients for latency in client.received.values())
+    print(f'{"outbox relay" if args.outbox else "in-process"} fan-out, {args.rounds} rounds x {len(clients)} clients')
+    print(f'  delivery p50 {statistics.median(latencies):7.1f} ms  p95 {percentile(latencies, 0.95):7.1f} ms  '
+          f'p99 {percentile(latencies, 0.99):7.1f} ms  max {latencies[-1]:7.1f} ms')
+    print(f'  last client reached after {statistics.median(completions) * 1000:.1f} ms (median round)')
+
+    for task in listeners:
+        task.cancel()
+    for client in clients:
+        client.writer.close()
+    server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--pause', type=float, default=0.2, help='seconds between rounds')
+    parser.add_argument('--outbox', action='store_true', help='publish through the outbox table')
+    args = parser.parse_args()
+
+    os.environ['RELATIKA_DATABASE'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ.pop('RELATIKA_STREAM_PORT', None)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app as app_module
+
+    asyncio.run(run(app_module, args))
+
+
+if __name__ == '__main__':
+    main()
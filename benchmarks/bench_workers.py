@@ -0,0 +1,109 @@
+"""Memory per worker process, with the match term data private or shared.
+
+Starts --workers processes at a time, each importing the app like a
+separate server worker on one database from benchmarks/dataset.py, and
+scores a profile against every user so the whole index is paged in. Each
+worker then reports its resident set (RSS) and proportional set (PSS,
+shared pages divided among the processes mapping them) from
+/proc/self/smaps_rollup. With MATCH_SHARED_MEMORY the tokenized about texts
+exist once in a shared segment, so PSS per worker stays flat as workers are
+added; with a private OverlapIndex every worker holds its own copy. Linux
+only.
+
+    python benchmarks/bench_workers.py --users 20000 --workers 1 2 4 8
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def memory_kb():
+    values = {}
+    with open('/proc/self/smaps_rollup') as rollup:
+        for line in rollup:
+            field, _, rest = line.partition(':')
+            if field in ('Rss', 'Pss'):
+                values[field] = int(rest.split()[0])
+    return values
+
+
+def worker(shared, started, measure, results):
+    sys.path.insert(0, str(ROOT))
+    import app as app_module
+    from matching import OverlapIndex
+
+    conn = app_module.connect_db()
+    if not shared:
+        segment = app_module.match_index.segment
+        app_module.match_index = OverlapIndex()
+        app_module.match_index.build(conn.execute('SELECT id, about FROM users').fetchall())
+        if segment is not None:
+            segment.close()
+    user_ids = [row['id'] for row in conn.execute('SELECT id FROM users')]
+    about = conn.execute('SELECT about FROM users WHERE about IS NOT NULL LIMIT 1').fetchone()['about']
+    conn.close()
+    app_module.match_index.match_percentages(about, user_ids)
+    started.wait()
+    # Measure once every worker has its index, so PSS splits the shared pages among all of them
+    measure.wait()
+    results.put(memory_kb())
+
+
+def run(workers, shared):
+    context = multiprocessing.get_context('spawn')
+    started = context.Barrier(workers + 1)
+    measure = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(shared, started, measure, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    started.wait()
+    measure.set()
+    samples = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['RELATIKA_DATABASE'] = database
+    sys.path.insert(0, str(ROOT))
+    import app as app_module
+    from dataset import populate
+    from shared_index import TermSegment
+
+    populate(database, args.users, args.seed)
+    # Publish a segment of the populated database before the workers start
+    conn = app_module.connect_db()
+    app_module.publish_match_segment(conn, app_module.match_generation(conn))
+    name = conn.execute('SELECT name FROM match_term_segments').fetchone()['name']
+    segment = TermSegment.attach(name)
+    print(f'{args.users} users, segment of {segment.nbytes / 1024:.0f} KiB', file=sys.stderr)
+    segment.close()
+
+    print(f'{"workers":>7}  {"index":>7}  {"RSS/worker":>11}  {"PSS/worker":>11}  {"PSS total":>10}')
+    for workers in args.workers:
+        for shared in (False, True):
+            samples = run(workers, shared)
+            rss = sum(sample['Rss'] for sample in samples) / len(samples) / 1024
+            pss = sum(sample['Pss'] for sample in samples) / 1024
+            print(f'{workers:7d}  {"shared" if shared else "private":>7}  {rss:8.1f} MB  {pss / workers:8.1f} MB  {pss:7.1f} MB')
+    for row in conn.execute('SELECT name FROM match_term_segments'):
+        TermSegment.unlink_name(row['name'])
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
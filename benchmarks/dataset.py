@@ -0,0 +1,156 @@
+"""Fill a fresh database with a synthetic but realistic population.
+
+Users get written-out `about` texts, coordinates around a set of cities,
+gender and looking_for choices, photo rows, saved profiles, and photo
+reveal and contact share requests in every state the app produces:
+pending, accepted (with the reciprocal row), declined, and acknowledged.
+Every user's password is PASSWORD. The same seed always yields the same
+database.
+
+    python benchmarks/dataset.py --users 10000 --output bench.db
+"""
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+PASSWORD = 'benchmark'
+
+CITIES = [
+    ('Berlin', 52.52, 13.405), ('Hamburg', 53.551, 9.993), ('Munich', 48.137, 11.575),
+    ('Frankfurt', 50.110, 8.682), ('Cologne', 50.937, 6.960), ('Vienna', 48.208, 16.373),
+    ('Zurich', 47.376, 8.541), ('Paris', 48.856, 2.352), ('Amsterdam', 52.370, 4.895),
+    ('Prague', 50.075, 14.437), ('Warsaw', 52.230, 21.012), ('Copenhagen', 55.676, 12.568),
+]
+FIRST_NAMES = ('Anna Ben Clara David Elena Felix Greta Hannah Ivan Jonas Katrin Leon Marie Noah Olga Paul '
+               'Rosa Sami Tara Uwe Vera Yusuf Zoe Lukas Mila Emil Ida Karl Lena Max').split()
+INTERESTS = ('hiking', 'jazz', 'indie music', 'travel', 'coffee', 'yoga', 'meditation', 'cooking', 'baking',
+             'dogs', 'cats', 'modern art', 'old movies', 'running', 'the beach', 'the mountains', 'salsa dancing',
+             'board games', 'wine tasting', 'green tea', 'film photography', 'science fiction', 'history',
+             'poetry', 'climbing', 'cycling', 'gardening', 'football', 'chess', 'volunteering', 'theatre')
+SENTENCES = (
+    'I love {0} and {1}.',
+    'Weekends are for {0}, evenings for {1}.',
+    'Looking for someone who enjoys {0} as much as I do.',
+    'Friends say I talk too much about {0}.',
+    'Currently learning more about {0}.',
+    'Happiest somewhere between {0} and {1}.',
+    'Ask me about {0}!',
+    'Not a fan of small talk, but always up for {0}.',
+    'Family matters a lot to me, and so does {0}.',
+    'Trying to spend less time on my phone and more on {0}.',
+)
+LOOKING_FOR = ('F', 'M', 'M,F', 'F,M,O', 'O', 'M,O')
+ANSWERED = ('accepted', 'declined')
+
+
+def about_text(rng):
+    if rng.random() < 0.05:
+        return None
+    sentences = []
+    for _ in range(rng.randint(1, 6)):
+        sentences.append(rng.choice(SENTENCES).format(*rng.sample(INTERESTS, 2)))
+    return ' '.join(sentences)
+
+
+def user_row(rng, index, password_hash):
+    city, latitude, longitude = rng.choice(CITIES)
+    first = rng.choice(FIRST_NAMES)
+    has_contacts = rng.random() < 0.6
+    return (f'user{index}', password_hash, about_text(rng), f'{first} {index}', rng.randint(18, 65),
+            rng.choices('MFO', weights=(48, 48, 4))[0], rng.choice(LOOKING_FOR), city,
+            latitude + rng.gauss(0, 0.15), longitude + rng.gauss(0, 0.2),
+            f'user{index}@example.com' if has_contacts else None,
+            f'+49 151 {index:07d}' if has_contacts else None,
+            f'@user{index}' if rng.random() < 0.4 else None,
+            f'@user{index}' if rng.random() < 0.3 else None)
+
+
+def request_rows(rng, user_ids, per_user, label):
+    """(requester_id, requestee_id, status, message) rows for one request table, in every state."""
+    rows = []
+    pairs = set()
+    for _ in range(int(len(user_ids) * per_user)):
+        requester_id, requestee_id = rng.sample(user_ids, 2)
+        # One request per pair and direction; an accepted one also takes the reverse direction
+        if (requester_id, requestee_id) in pairs or (requestee_id, requester_id) in pairs:
+            continue
+        pairs.add((requester_id, requestee_id))
+        state = rng.random()
+        if state < 0.45:
+            rows.append((requester_id, requestee_id, 'pending', None))
+            continue
+        status = rng.choice(ANSWERED)
+        if state < 0.75:
+            message = f'Your {label} request to user {requestee_id} has been {status}.'
+        else:
+            message = 'Acknowledged'
+        rows.append((requester_id, requestee_id, status, message))
+        if status == 'accepted':
+            # Accepting also grants the reverse direction, as the handlers do
+            pairs.add((requestee_id, requester_id))
+            rows.append((requestee_id, requester_id, 'accepted', None))
+    return rows
+
+
+def populate(database, users, seed=1, saved_per_user=5, requests_per_user=3):
+    """Add `users` users and their activity to the migrated database at `database`."""
+    from werkzeug.security import generate_password_hash
+    from photos import variant_names
+
+    rng = random.Random(seed)
+    password_hash = generate_password_hash(PASSWORD)
+    conn = sqlite3.connect(database)
+    first_id = (conn.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0) + 1
+    conn.executemany('INSERT INTO users (username, password, about, name, age, gender, looking_for, location, latitude, longitude, '
+                     'email, tel, instagram, telegram) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (user_row(rng, first_id + i, password_hash) for i in range(users)))
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users WHERE id >= ?', (first_id,))]
+
+    photos = []
+    for user_id in user_ids:
+        for number in range(rng.choices((0, 1, 2, 3), weights=(25, 40, 25, 10))[0]):
+            content_hash = hashlib.sha256(b'%d:%d:%d' % (seed, user_id, number)).hexdigest()
+            filename = content_hash + '.jpg'
+            photos.append((user_id, filename, content_hash) + variant_names(filename))
+    conn.executemany('INSERT INTO photos (user_id, filename, content_hash, thumb_filename, thumb_webp_filename) '
+                     'VALUES (?, ?, ?, ?, ?)', photos)
+
+    saved = {tuple(rng.sample(user_ids, 2)) for _ in range(len(user_ids) * saved_per_user)}
+    conn.executemany('INSERT OR IGNORE INTO saved_profiles (user_id, profile_id) VALUES (?, ?)', saved)
+
+    for table, label in (('photo_reveals', 'photo reveal'), ('contact_shares', 'contact share')):
+        conn.executemany(f'INSERT INTO {table} (requester_id, requestee_id, status, message) VALUES (?, ?, ?, ?)',
+                         request_rows(rng, user_ids, requests_per_user, label))
+    # A bulk load is scored by `flask rebuild-match-scores` (or live on first view), not user by user
+    conn.execute('DELETE FROM match_dirty')
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    return user_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--output', required=True, help='database file to create')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        parser.error(f'{args.output} already exists')
+    os.environ['RELATIKA_DATABASE'] = os.path.abspath(args.output)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import app  # noqa: F401  (creates the schema)
+
+    started = time.perf_counter()
+    populate(args.output, args.users, args.seed)
+    print(f'{args.users} users written to {args.output} in {time.perf_counter() - started:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class MaintenanceScheduler:
+    """Periodic housekeeping jobs, run in short time slices on one background thread.
+
+    A job is a generator function taking a database connection; after each
+    small step it yields (items removed, bytes reclaimed). The scheduler
+    advances a job for at most `slice_seconds` at a time and sleeps
+    `pause_seconds` between slices, so neither the GIL nor the database
+    write lock is held long enough to show in request latency.
+
+    Every `check_seconds` the thread asks claim(conn, name, interval) for
+    each job and runs those it is granted; claims live in the database, so
+    of several worker processes only one runs a given job. Each run's report
+    goes to record(conn, name, report).
+    """
+
+    def __init__(self, connect, claim, record, slice_seconds=0.05, pause_seconds=0.5, check_seconds=60):
+        self.slice_seconds = slice_seconds
+        self.pause_seconds = pause_seconds
+        self.check_seconds = check_seconds
+        self.jobs = {}
+        self._connect = connect
+        self._claim = claim
+        self._record = record
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, name, func, interval):
+        self.jobs[name] = (func, interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+                self._thread.start()
+
+    def run_job(self, name, conn, pause_seconds=None):
+        """Run a job to the end now, slice by slice, and return its report."""
+        func, _ = self.jobs[name]
+        pause = self.pause_seconds if pause_seconds is None else pause_seconds
+        report = {'started': time.time(), 'seconds': 0.0, 'slices': 0, 'removed': 0, 'bytes_reclaimed': 0, 'error': None}
+        started = time.perf_counter()
+        steps = func(conn)
+        try:
+            while True:
+                slice_started = time.perf_counter()
+                try:
+                    while time.perf_counter() - slice_started < self.slice_seconds:
+                        removed, reclaimed = next(steps)
+                        report['removed'] += removed
+                        report['bytes_reclaimed'] += reclaimed
+                finally:
+                    report['seconds'] += time.perf_counter() - slice_started
+                    report['slices'] += 1
+                time.sleep(pause)
+        except StopIteration:
+            pass
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            report['error'] = str(e)
+        # Wall-clock time including the pauses; 'seconds' is the time spent working
+        report['elapsed'] = time.perf_counter() - started
+        self._record(conn, name, report)
+        return report
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            time.sleep(self.check_seconds)
+            for name, (_, interval) in list(self.jobs.items()):
+                try:
+                    if self._claim(conn, name, interval):
+                        self.run_job(name, conn)
+                except Exception as e:
+                    print(f"Error running maintenance job {name}: {e}")
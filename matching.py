@@ -0,0 +1,353 @@
+import heapq
+import re
+import threading
+from collections import Counter
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+WORD_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return WORD_RE.findall((text or '').lower())
+
+
+def top_scores(ids, scores, k, user_ids=None):
+    """Return the k best (user_id, score) pairs of parallel arrays, best first and ties by id.
+
+    With `user_ids` only those users compete, and any of them missing from
+    `ids` scores 0, as in match_percentages(). argpartition finds the k best
+    in linear time and only they get sorted; users tied with the k-th best
+    are cut by id, so the result never depends on the partition order.
+    """
+    if k <= 0:
+        return []
+    if user_ids is not None:
+        candidates = np.unique(np.asarray(user_ids, dtype=np.int64))
+        restricted = np.zeros(len(candidates), dtype=scores.dtype)
+        positions = np.searchsorted(candidates, ids)
+        listed = positions < len(candidates)
+        listed[listed] = candidates[positions[listed]] == ids[listed]
+        restricted[positions[listed]] = scores[listed]
+        ids, scores = candidates, restricted
+    if k < len(ids):
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        better = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)
+        tied = tied[np.argsort(ids[tied], kind='stable')][:k - len(better)]
+        best = np.concatenate([better, tied])
+        ids, scores = ids[best], scores[best]
+    order = np.lexsort((ids, -scores))
+    return list(zip(ids[order].tolist(), scores[order].tolist()))
+
+
+class OverlapIndex:
+    """Inverted index over the users' `about` texts.
+
+    Postings map every token to the users whose `about` contains it, together
+    with how often it occurs there, so scoring one profile only touches the
+    users that share at least one word with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._terms = {}
+
+    def build(self, rows):
+        with self._lock:
+            self._postings = {}
+            self._terms = {}
+            for row in rows:
+                self._add(row['id'], row['about'])
+
+    def update(self, user_id, about):
+        with self._lock:
+            self._remove(user_id)
+            self._add(user_id, about)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def match_percentages(self, about, user_ids):
+        """Return {user_id: match percentage} of `about` against each of `user_ids`.
+
+        The percentage is the multiset overlap of both word lists divided by
+        the number of distinct words in either, times 100. Large candidate
+        sets are scored through the postings, which only visits users sharing
+        a word with `about`; small pre-filtered sets are compared directly.
+        """
+        words = Counter(tokenize(about))
+        matches = Counter()
+        shared = Counter()
+        with self._lock:
+            if len(user_ids) * 4 < len(self._terms):
+                for user_id in user_ids:
+                    terms = self._terms.get(user_id, {})
+                    for token, count in words.items():
+                        if token in terms:
+                            matches[user_id] += min(count, terms[token])
+                            shared[user_id] += 1
+            else:
+                for token, count in words.items():
+                    for user_id, other_count in self._postings.get(token, {}).items():
+                        matches[user_id] += min(count, other_count)
+                        shared[user_id] += 1
+            percentages = {}
+            for user_id in user_ids:
+                total_words = len(words) + len(self._terms.get(user_id, ())) - shared[user_id]
+                percentages[user_id] = (matches[user_id] / total_words) * 100 if total_words > 0 else 0
+            return percentages
+
+    def top_matches(self, about, k, user_ids=None):
+        """Return the k best (user_id, percentage) pairs among `user_ids`, best first and ties by id.
+
+        Without `user_ids` every indexed user competes.
+        """
+        if user_ids is None:
+            with self._lock:
+                user_ids = list(self._terms)
+        percentages = self.match_percentages(about, user_ids)
+        return heapq.nsmallest(k, percentages.items(), key=lambda item: (-item[1], item[0]))
+
+    def _add(self, user_id, about):
+        terms = Counter(tokenize(about))
+        if not terms:
+            return
+        self._terms[user_id] = terms
+        for token, count in terms.items():
+            self._postings.setdefault(token, {})[user_id] = count
+
+    def _remove(self, user_id):
+        terms = self._terms.pop(user_id, None)
+        if not terms:
+            return
+        for token in terms:
+            postings = self._postings[token]
+            del postings[user_id]
+            if not postings:
+                del self._postings[token]
+
+
+class VectorIndex:
+    """Sparse term matrix over the users' `about` texts, scored with TF-IDF or BM25.
+
+    Scoring one profile against everybody is a single sparse matrix-vector
+    product. Edits do not rebuild the matrix: changed users are masked out of
+    it and scored from a small side matrix until enough of them pile up, at
+    which point the main matrix is rebuilt in one go.
+    """
+
+    COMPACT_MIN_ROWS = 256
+    COMPACT_RATIO = 0.05
+
+    def __init__(self, scheme='tfidf', k1=1.2, b=0.75):
+        if np is None:
+            raise RuntimeError('The %s match engine requires numpy and scipy' % scheme)
+        if scheme not in ('tfidf', 'bm25'):
+            raise ValueError('Unknown scoring scheme: %s' % scheme)
+        self.scheme = scheme
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._vocabulary = {}
+        self._df = np.zeros(1024, dtype=np.int64)
+        self._terms = {}
+        self._total_length = 0
+        self._main = None
+        self._main_ids = np.zeros(0, dtype=np.int64)
+        self._main_rows = {}
+        self._main_alive = np.zeros(0, dtype=bool)
+        self._dirty = set()
+        self._delta = None
+        self._cache = {}
+
+    def build(self, rows):
+        with self._lock:
+            self._vocabulary = {}
+            self._df = np.zeros(1024, dtype=np.int64)
+            self._terms = {}
+            self._total_length = 0
+            for row in rows:
+                self._add(row['id'], row['about'])
+            self._compact()
+
+    def update(self, user_id, about):
+        with self._lock:
+            self._remove(user_id)
+            self._add(user_id, about)
+            self._mark_dirty(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+            self._mark_dirty(user_id)
+
+    def match_percentages(self, about, user_ids):
+        with self._lock:
+            ids, scores = self._score(about)
+        percentages = dict.fromkeys(user_ids, 0.0)
+        for user_id, score in zip(ids.tolist(), scores.tolist()):
+            if user_id in percentages:
+                percentages[user_id] = score
+        return percentages
+
+    def top_matches(self, about, k, user_ids=None):
+        with self._lock:
+            ids, scores = self._score(about)
+        return top_scores(ids, scores, k, user_ids)
+
+    def _score(self, about):
+        """Return parallel arrays of user ids and percentages for every indexed user."""
+        words = Counter(tokenize(about))
+        n_docs = len(self._terms)
+        if not words or not n_docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        columns = np.array([self._vocabulary.get(token, -1) for token in words], dtype=np.int64)
+        counts = np.array(list(words.values()), dtype=np.float64)
+        df = np.where(columns >= 0, self._df[np.maximum(columns, 0)], 0)
+        known = columns >= 0
+        query = np.zeros(len(self._vocabulary))
+
+        if self.scheme == 'tfidf':
+            idf = np.log((1 + n_docs) / (1 + df)) + 1
+            weights = counts * idf
+            query_norm = np.sqrt(np.dot(weights, weights))
+            query[columns[known]] = weights[known] * idf[known]
+            idf_squared = self._idf_tfidf(n_docs) ** 2
+            parts = [self._tfidf_scores(part, query, idf_squared, query_norm) for part in self._matrices()]
+        else:
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            query[columns[known]] = (counts * idf)[known]
+            average_length = self._total_length / n_docs
+            parts = [self._bm25_scores(part, query, average_length) for part in self._matrices()]
+
+        ids = np.concatenate([part_ids for part_ids, _ in parts])
+        scores = np.concatenate([part_scores for _, part_scores in parts])
+        if self.scheme == 'bm25' and len(scores) and scores.max() > 0:
+            # BM25 is unbounded; express it relative to the best candidate
+            scores = scores / scores.max()
+        return ids, scores * 100
+
+    def _matrices(self):
+        # The main matrix without rows edited since the last compaction, plus the edited rows
+        if self._main is not None and len(self._main_ids):
+            yield self._main, self._main_ids, self._main_alive if self._dirty else None
+        if self._dirty:
+            if self._delta is None:
+                self._delta = self._matrix_for([user_id for user_id in self._dirty if user_id in self._terms])
+            yield self._delta[0], self._delta[1], None
+
+    def _idf_tfidf(self, n_docs):
+        df = self._df[:len(self._vocabulary)]
+        return np.log((1 + n_docs) / (1 + df)) + 1
+
+    def _tfidf_scores(self, part, query, idf_squared, query_norm):
+        matrix, ids, alive = part
+        dot = matrix @ query[:matrix.shape[1]]
+        norms = self._cached(('norms', id(matrix)), lambda: np.sqrt(matrix.multiply(matrix) @ idf_squared[:matrix.shape[1]]))
+        scores = np.divide(dot, norms * query_norm, out=np.zeros_like(dot), where=norms > 0)
+        return self._alive(ids, scores, alive)
+
+    def _bm25_scores(self, part, query, average_length):
+        matrix, ids, alive = part
+
+        def saturate():
+            lengths = np.asarray(matrix.sum(axis=1)).ravel()
+            row_norm = self.k1 * (1 - self.b + self.b * lengths / average_length)
+            tf = matrix.data
+            saturated = tf * (self.k1 + 1) / (tf + np.repeat(row_norm, np.diff(matrix.indptr)))
+            return sparse.csr_matrix((saturated, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+        weighted = self._cached(('bm25', id(matrix)), saturate)
+        return self._alive(ids, weighted @ query[:matrix.shape[1]], alive)
+
+    def _cached(self, key, compute):
+        # Document norms and BM25 weights depend on corpus statistics, so any edit clears them
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    @staticmethod
+    def _alive(ids, scores, alive):
+        if alive is None:
+            return ids, scores
+        return ids[alive], scores[alive]
+
+    def _matrix_for(self, user_ids):
+        indptr = [0]
+        indices = []
+        data = []
+        for user_id in user_ids:
+            terms = self._terms[user_id]
+            indices.extend(self._vocabulary[token] for token in terms)
+            data.extend(terms.values())
+            indptr.append(len(indices))
+        matrix = sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr)),
+                                   shape=(len(user_ids), len(self._vocabulary)))
+        return matrix, np.array(user_ids, dtype=np.int64)
+
+    def _compact(self):
+        user_ids = sorted(self._terms)
+        self._main, self._main_ids = self._matrix_for(user_ids)
+        self._main_rows = {user_id: row for row, user_id in enumerate(user_ids)}
+        self._main_alive = np.ones(len(user_ids), dtype=bool)
+        self._dirty = set()
+        self._delta = None
+        self._cache = {}
+
+    def _mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+        self._delta = None
+        self._cache = {}
+        if user_id in self._main_rows:
+            self._main_alive[self._main_rows[user_id]] = False
+        if len(self._dirty) > max(self.COMPACT_MIN_ROWS, self.COMPACT_RATIO * len(self._main_ids)):
+            self._compact()
+
+    def _add(self, user_id, about):
+        terms = Counter(tokenize(about))
+        if not terms:
+            return
+        self._terms[user_id] = terms
+        self._total_length += sum(terms.values())
+        for token in terms:
+            column = self._vocabulary.get(token)
+            if column is None:
+                column = self._vocabulary[token] = len(self._vocabulary)
+                if column >= len(self._df):
+                    self._df = np.concatenate([self._df, np.zeros(len(self._df), dtype=np.int64)])
+            self._df[column] += 1
+
+    def _remove(self, user_id):
+        terms = self._terms.pop(user_id, None)
+        if not terms:
+            return
+        self._total_length -= sum(terms.values())
+        for token in terms:
+            self._df[self._vocabulary[token]] -= 1
+
+
+def create_index(engine, vector_store_path=None, vector_dim=256, shared=False):
+    """Return an empty match index for the named scoring engine.
+
+    With `shared`, the 'overlap' engine keeps its term data in shared memory
+    that all worker processes map; the other engines ignore it.
+    """
+    if engine == 'overlap':
+        if shared:
+            from shared_index import SharedOverlapIndex
+            return SharedOverlapIndex()
+        return OverlapIndex()
+    if engine in ('tfidf', 'bm25'):
+        return VectorIndex(engine)
+    if engine == 'embedding':
+        from vector_store import EmbeddingIndex
+        return EmbeddingIndex(vector_store_path, vector_dim)
+    raise ValueError('Unknown match engine: %s' % engine)
@@ -0,0 +1,152 @@
+import sqlite3
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    """Prometheus-style histogram with one series per endpoint."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # endpoint -> [count per bucket (not cumulative), +Inf count, sum]
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0, 0.0])
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            series = self._series[endpoint]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((endpoint, list(counts), count, total) for endpoint, (counts, count, total) in self._series.items())
+        for endpoint, counts, count, total in series:
+            label = 'endpoint="%s"' % endpoint.replace('\\', '\\\\').replace('"', '\\"')
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return '\n'.join(lines)
+
+
+class RequestStats:
+    """What one request spent, filled in by the instrumented connection and the request hooks.
+
+    `queries` collects (sql, seconds to execute) for every statement when it
+    is a list; it is None unless the slow request log needs it. Fetch time
+    only goes into sql_seconds.
+    """
+
+    __slots__ = ('started', 'statements', 'sql_seconds', 'load_user_seconds', 'template_seconds',
+                 'template_depth', 'template_started', 'queries')
+
+    def __init__(self, capture_queries=False):
+        self.started = perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.load_user_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.template_started = 0.0
+        self.queries = [] if capture_queries else None
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Rows are stepped out of SQLite while fetching, so fetches count as SQL time too.
+    # Iterating fetches everything in one timed call rather than paying Python per row.
+
+    def execute(self, sql, parameters=()):
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record(sql, perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.record(sql, perf_counter() - started)
+
+    def fetchone(self):
+        started = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.record(None, perf_counter() - started)
+
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self.connection.record(None, perf_counter() - started)
+
+    def fetchall(self):
+        started = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.record(None, perf_counter() - started)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection factory that charges statements and their time to `stats`.
+
+    `stats` is the current request's RequestStats while a request holds the
+    connection, and None otherwise, when recording costs one attribute check.
+    """
+
+    stats = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        started = perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            self.record(script, perf_counter() - started)
+
+    def commit(self):
+        started = perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.record('COMMIT', perf_counter() - started)
+
+    def record(self, sql, seconds):
+        stats = self.stats
+        if stats is None:
+            return
+        stats.sql_seconds += seconds
+        if sql is not None:
+            stats.statements += 1
+            if stats.queries is not None:
+                stats.queries.append((sql, seconds))
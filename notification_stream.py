@@ -0,0 +1,220 @@
+import asyncio
+import json
+import socket
+import threading
+from collections import defaultdict, deque
+from http.cookies import CookieError, SimpleCookie
+
+HEARTBEAT_SECONDS = 15
+RELAY_INTERVAL_SECONDS = 0.25
+SUBSCRIBER_QUEUE_SIZE = 64
+
+
+def format_event(event):
+    return ('data: %s\n\n' % json.dumps(event)).encode('utf-8')
+
+
+def parse_cookies(header):
+    cookies = SimpleCookie()
+    try:
+        cookies.load(header or '')
+    except CookieError:
+        return {}
+    return {name: morsel.value for name, morsel in cookies.items()}
+
+
+class NotificationBroker:
+    """In-process pub/sub of notification events, keyed by user id.
+
+    Subscribers are plain callables that must not block; publish() calls
+    them on the publishing thread. Every event carries the user's current
+    count, so a subscriber that falls behind can drop events safely.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, user_id, deliver):
+        with self._lock:
+            self._subscribers[user_id].add(deliver)
+
+    def unsubscribe(self, user_id, deliver):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is None:
+                return
+            subscribers.discard(deliver)
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id):
+        with self._lock:
+            return user_id in self._subscribers
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for deliver in subscribers:
+            deliver(event)
+        return len(subscribers)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+class StreamServer:
+    """Minimal asyncio HTTP server that only speaks the notification event stream.
+
+    One event loop holds every idle connection, so thousands of clients cost
+    a socket and a small queue each instead of a thread. The callables bridge
+    back to the application and run in the loop's thread pool:
+
+    - authenticate(cookies) returns the user id of a request or None
+    - first_event(user_id) returns the event sent on connect
+    - relay(after_id) returns (last_id, [(user_id, event)]) for events
+      published by other processes since after_id; it is polled every
+      RELAY_INTERVAL_SECONDS and called once with None for the start id
+    """
+
+    def __init__(self, broker, authenticate, first_event, relay=None, path='/notifications/stream',
+                 host='127.0.0.1', port=0, heartbeat=HEARTBEAT_SECONDS):
+        self.broker = broker
+        self.authenticate = authenticate
+        self.first_event = first_event
+        self.relay = relay
+        self.path = path
+        self.host = host
+        self.port = port
+        self.heartbeat = heartbeat
+        self._ready = threading.Event()
+        self._loop = None
+        self._server = None
+        self._inbox = deque()
+        self._inbox_lock = threading.Lock()
+        self._drain_scheduled = False
+
+    def start(self):
+        """Serve from a daemon thread; returns once the socket is listening."""
+        thread = threading.Thread(target=self.serve_forever, name='notification-stream', daemon=True)
+        thread.start()
+        self._ready.wait()
+        return self
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        # SO_REUSEPORT lets every worker process listen on the same port
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096,
+                                                  reuse_port=hasattr(socket, 'SO_REUSEPORT'))
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.relay is not None:
+            relay_task = asyncio.create_task(self._relay())
+        self._ready.set()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.relay is not None:
+                relay_task.cancel()
+
+    def _post(self, offer, event):
+        # Called from publishing threads; a burst of events costs one loop wake-up, not one per connection
+        with self._inbox_lock:
+            self._inbox.append((offer, event))
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        self._loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._inbox_lock:
+            posted = list(self._inbox)
+            self._inbox.clear()
+            self._drain_scheduled = False
+        for offer, event in posted:
+            offer(event)
+
+    async def _relay(self):
+        loop = asyncio.get_running_loop()
+        last_id, _ = await loop.run_in_executor(None, self.relay, None)
+        while True:
+            await asyncio.sleep(RELAY_INTERVAL_SECONDS)
+            try:
+                last_id, events = await loop.run_in_executor(None, self.relay, last_id)
+            except Exception as e:
+                print("Error relaying notifications:", e)
+                continue
+            for user_id, event in events:
+                self.broker.publish(user_id, event)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            if method != 'GET' or target.split('?', 1)[0] != self.path:
+                await self._respond(writer, '404 Not Found')
+                return
+            loop = asyncio.get_running_loop()
+            user_id = await loop.run_in_executor(None, self.authenticate, parse_cookies(headers.get('cookie')))
+            if user_id is None:
+                await self._respond(writer, '401 Unauthorized')
+                return
+            await self._stream(writer, user_id)
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, writer, user_id):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+        def offer(event):
+            if not events.full():
+                events.put_nowait(event)
+
+        def deliver(event):
+            self._post(offer, event)
+
+        # Subscribe before reading the first event so nothing published in between is lost
+        self.broker.subscribe(user_id, deliver)
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/event-stream\r\n'
+                         b'Cache-Control: no-cache\r\n'
+                         b'Connection: keep-alive\r\n'
+                         b'X-Accel-Buffering: no\r\n\r\n'
+                         b'retry: 5000\n\n')
+            writer.write(format_event(await loop.run_in_executor(None, self.first_event, user_id)))
+            await writer.drain()
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                else:
+                    writer.write(format_event(event))
+                await writer.drain()
+        finally:
+            self.broker.unsubscribe(user_id, deliver)
+
+    @staticmethod
+    async def _respond(writer, status):
+        writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status).encode('latin-1'))
+        await writer.drain()
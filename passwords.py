@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Too many password operations are already running or waiting."""
+
+
+class PasswordHasher:
+    """Password hashing and verification on a small pool of their own.
+
+    The key derivation functions werkzeug uses (scrypt, pbkdf2) run inside
+    OpenSSL with the GIL released, so a few threads keep as many cores busy
+    as processes would, without forking a multi-threaded server. At most
+    `max_pending` operations may be running or queued; beyond that callers
+    get HasherBusy at once, so a burst of sign-ins is turned away instead of
+    tying up every request worker behind it.
+    """
+
+    def __init__(self, method, workers, max_pending, timeout):
+        self.method = method
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # Hashes start with their method and parameters, e.g. 'scrypt:32768:8:1$salt$hash'
+        return pwhash.split('$', 1)[0] != self.method
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy() from None
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+THUMBS_FOLDER = 'thumbs'
+# Names the database whose photos the folder holds; see claim_folder()
+OWNER_FILE = '.owner'
+# mkstemp creates files readable only by their owner; uploads are served as static files
+FILE_MODE = 0o644
+
+# Leading bytes of the formats browsers display, so the stored extension follows the content
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+
+def sniff_extension(head, client_filename):
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    extension = os.path.splitext(client_filename or '')[1].lstrip('.').lower()
+    return extension if extension.isalnum() else 'bin'
+
+
+def spool_upload(stream, client_filename, folder):
+    """Copy an upload into a temporary file in `folder`, hashing it on the way.
+
+    Returns (sha256 hex digest, content-addressed filename, temporary path),
+    or None for an empty upload. The file is only given its final name by
+    place_upload(), once the caller has recorded it.
+    """
+    digest = hashlib.sha256()
+    head = b''
+    size = 0
+    fd, temporary = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(head) < 16:
+                    head += chunk[:16]
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    if not size:
+        os.remove(temporary)
+        return None
+    content_hash = digest.hexdigest()
+    return content_hash, '%s.%s' % (content_hash, sniff_extension(head, client_filename)), temporary
+
+
+def place_upload(temporary, path):
+    # Identical content is already stored under the same name; keep that copy
+    if os.path.exists(path):
+        os.remove(temporary)
+    else:
+        os.chmod(temporary, FILE_MODE)
+        os.replace(temporary, path)
+
+
+def variant_names(filename):
+    """Names of the thumbnail variants of an upload, relative to the upload folder."""
+    return (os.path.join(THUMBS_FOLDER, filename + '.jpg'), os.path.join(THUMBS_FOLDER, filename + '.webp'))
+
+
+def make_variants(folder, filename, size):
+    """Write a JPEG and a WebP thumbnail of `filename`, at most size x size pixels.
+
+    Returns the variant names from variant_names(). Each file is written
+    under a temporary name first, so readers never see a partial image.
+    """
+    if Image is None:
+        raise RuntimeError('Photo variants require Pillow')
+    os.makedirs(os.path.join(folder, THUMBS_FOLDER), exist_ok=True)
+    names = variant_names(filename)
+    with Image.open(os.path.join(folder, filename)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        rgb = image.convert('RGB')
+        for name, options in zip(names, ({'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+                                         {'format': 'WEBP', 'quality': 80, 'method': 4})):
+            path = os.path.join(folder, name)
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.variant-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    rgb.save(f, **options)
+                os.chmod(temporary, FILE_MODE)
+                os.replace(temporary, path)
+            except BaseException:
+                os.remove(temporary)
+                raise
+    return names
+
+
+def remove_upload(folder, filename):
+    for name in (filename,) + variant_names(filename):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def folder_owner(folder):
+    """The owner recorded in `folder` by claim_folder(), or None if it has none."""
+    try:
+        with open(os.path.join(folder, OWNER_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def claim_folder(folder, owner):
+    """Record `owner` as the owner of `folder` unless it has one already.
+
+    Returns the owner recorded now, which is someone else's when another
+    process claimed the folder first.
+    """
+    try:
+        fd = os.open(os.path.join(folder, OWNER_FILE), os.O_WRONLY | os.O_CREAT | os.O_EXCL, FILE_MODE)
+    except FileExistsError:
+        return folder_owner(folder)
+    with os.fdopen(fd, 'w') as f:
+        f.write(owner + '\n')
+    return owner
@@ -0,0 +1,26 @@
+import zlib
+
+
+def feistel(value, seed, bits, rounds=4):
+    """Keyed bijection on the integers [0, 2**bits) for an even number of bits."""
+    half = bits // 2
+    mask = (1 << half) - 1
+    left, right = value >> half, value & mask
+    for round_number in range(rounds):
+        key = zlib.crc32(b'%d:%d:%d' % (seed, round_number, right))
+        left, right = right, left ^ (key & mask)
+    return (left << half) | right
+
+
+def shuffled_positions(seed, limit, start=0):
+    """Yield (position, value) pairs visiting every value in [0, limit) once, in an order fixed by `seed`.
+
+    The shuffle is computed rather than stored, so a deck over any number of
+    values is fully described by (seed, limit, position).
+    """
+    bits = max(2, (limit - 1).bit_length())
+    bits += bits % 2
+    for position in range(start, 1 << bits):
+        value = feistel(position, seed, bits)
+        if value < limit:
+            yield position, value
@@ -0,0 +1,344 @@
+import heapq
+import os
+import secrets
+import struct
+import sys
+import threading
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+from matching import tokenize
+
+MAGIC = b'RLKTRM01'
+# magic, generation, user id slots, terms, (user, term) entries, vocabulary bytes
+HEADER = struct.Struct('<8sqqqqq')
+HEADER_SIZE = 64
+
+
+# Python 3.13 can leave a segment out of the resource tracker from the start
+_TRACK_OPTION = sys.version_info >= (3, 13)
+
+
+def _open(name, create=False, size=0):
+    # Segments outlive the process that created or attached them; whoever publishes a newer
+    # one unlinks the old. Left tracked, Python's resource tracker would unlink them when
+    # this process exits, pulling them from under the other workers. (Before 3.13 a segment is
+    # registered for a moment; workers sharing one tracker may make it log a harmless KeyError.)
+    if _TRACK_OPTION:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    if resource_tracker is not None and os.name == 'posix':
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _unlink(shm):
+    # Before 3.13, unlinking also unregisters from the resource tracker, so register again first
+    if not _TRACK_OPTION and resource_tracker is not None and os.name == 'posix':
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+class TermSegment:
+    """Tokenized about texts of every user in one read-only shared memory block.
+
+    Every worker process maps the same block, so the term data exists once
+    per machine instead of once per worker. After a 64 byte header come,
+    each 8-byte aligned:
+
+        sizes       int32[slots]       distinct terms of each user id, 0 for none
+        user_start  int64[slots + 1]   where each user id's terms start in
+        user_terms, user_counts        int32[entries], term ids ascending
+        term_start  int64[terms + 1]   where each term's postings start in
+        term_users, term_counts        int32[entries], user ids ascending
+        word_start  int64[terms + 1]   where each term's UTF-8 text starts in
+        words       bytes              the terms, sorted bytewise
+
+    Slots are indexed by user id directly. A block is never written after
+    it is built; changes go into a newer one.
+    """
+
+    def __init__(self, shm):
+        self._shm = shm
+        magic, self.generation, slots, terms, entries, words = HEADER.unpack_from(shm.buf)
+        if magic != MAGIC:
+            raise ValueError('%s is not a term segment' % shm.name)
+        self.name = shm.name.lstrip('/')
+        self.nbytes = shm.size
+        self.slots = slots
+        self.terms = terms
+        self._views = []
+        offset = HEADER_SIZE
+        layout = [('sizes', 'i', slots), ('user_start', 'q', slots + 1), ('user_terms', 'i', entries), ('user_counts', 'i', entries),
+                  ('term_start', 'q', terms + 1), ('term_users', 'i', entries), ('term_counts', 'i', entries),
+                  ('word_start', 'q', terms + 1), ('words', 'B', words)]
+        for attribute, typecode, length in layout:
+            size = length * array(typecode).itemsize
+            view = shm.buf[offset:offset + size].cast(typecode)
+            self._views.append(view)
+            setattr(self, attribute, view)
+            offset = _aligned(offset + size)
+        self.users = slots - self.sizes.tolist().count(0)
+
+    @classmethod
+    def create(cls, rows, generation=0, name=None):
+        """Build a segment from (id, about) rows. Without a name it is private to this process."""
+        texts = {}
+        for row in rows:
+            counts = Counter(tokenize(row['about']))
+            if counts:
+                texts[row['id']] = counts
+        words = sorted({token.encode('utf-8') for counts in texts.values() for token in counts})
+        term_ids = {word.decode('utf-8'): term_id for term_id, word in enumerate(words)}
+        slots = max(texts, default=-1) + 1
+
+        sizes = array('i', bytes(4 * slots))
+        user_start = array('q', bytes(8 * (slots + 1)))
+        user_terms = array('i')
+        user_counts = array('i')
+        frequencies = [0] * len(words)
+        for user_id in range(slots):
+            user_start[user_id] = len(user_terms)
+            counts = texts.get(user_id)
+            if counts:
+                sizes[user_id] = len(counts)
+                for term_id, count in sorted((term_ids[token], count) for token, count in counts.items()):
+                    user_terms.append(term_id)
+                    user_counts.append(count)
+                    frequencies[term_id] += 1
+        user_start[slots] = len(user_terms)
+
+        # Postings by counting sort: users are visited in id order, so each term's list comes out sorted
+        term_start = array('q', [0])
+        for frequency in frequencies:
+            term_start.append(term_start[-1] + frequency)
+        cursor = list(term_start[:-1])
+        term_users = array('i', bytes(4 * len(user_terms)))
+        term_counts = array('i', bytes(4 * len(user_terms)))
+        for user_id in range(slots):
+            for entry in range(user_start[user_id], user_start[user_id + 1]):
+                term_id = user_terms[entry]
+                position = cursor[term_id]
+                term_users[position] = user_id
+                term_counts[position] = user_counts[entry]
+                cursor[term_id] = position + 1
+
+        word_start = array('q', [0])
+        for word in words:
+            word_start.append(word_start[-1] + len(word))
+        blob = b''.join(words)
+
+        parts = [sizes, user_start, user_terms, user_counts, term_start, term_users, term_counts, word_start, blob]
+        size = HEADER_SIZE + sum(_aligned(len(memoryview(part).cast('B'))) for part in parts)
+        shm = _open(name or cls._private_name(), create=True, size=size)
+        try:
+            HEADER.pack_into(shm.buf, 0, MAGIC, generation, slots, len(words), len(user_terms), len(blob))
+            offset = HEADER_SIZE
+            for part in parts:
+                data = memoryview(part).cast('B')
+                shm.buf[offset:offset + len(data)] = data
+                offset = _aligned(offset + len(data))
+            segment = cls(shm)
+        except BaseException:
+            shm.close()
+            _unlink(shm)
+            raise
+        if name is None:
+            # Nobody else attaches a private segment; the memory goes away with the last mapping
+            _unlink(shm)
+        return segment
+
+    @classmethod
+    def attach(cls, name):
+        """Map a published segment. Raises FileNotFoundError when it no longer exists."""
+        shm = _open(name)
+        try:
+            return cls(shm)
+        except BaseException:
+            shm.close()
+            raise
+
+    @staticmethod
+    def unlink_name(name):
+        # Other processes keep their mapping; the memory is freed once the last one closes it
+        try:
+            shm = _open(name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        _unlink(shm)
+
+    @staticmethod
+    @contextmanager
+    def build_lock(path):
+        # Processes build one at a time, so a burst of them starting up builds once
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def term_id(self, token):
+        # Binary search over the sorted vocabulary
+        word = token.encode('utf-8')
+        low, high = 0, self.terms
+        while low < high:
+            middle = (low + high) // 2
+            found = bytes(self.words[self.word_start[middle]:self.word_start[middle + 1]])
+            if found < word:
+                low = middle + 1
+            elif found > word:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def postings(self, term_id):
+        start, end = self.term_start[term_id], self.term_start[term_id + 1]
+        return self.term_users[start:end], self.term_counts[start:end]
+
+    def user_terms_of(self, user_id):
+        if not 0 <= user_id < self.slots:
+            return (), ()
+        start, end = self.user_start[user_id], self.user_start[user_id + 1]
+        return self.user_terms[start:end], self.user_counts[start:end]
+
+    def size(self, user_id):
+        return self.sizes[user_id] if 0 <= user_id < self.slots else 0
+
+    def user_ids(self):
+        return [user_id for user_id, size in enumerate(self.sizes) if size]
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._shm.close()
+
+    def unlink(self):
+        _unlink(self._shm)
+        self.close()
+
+    @staticmethod
+    def _private_name():
+        return 'rlk_%d_%s' % (os.getpid(), secrets.token_hex(4))
+
+    def __del__(self):
+        if getattr(self, '_views', None):
+            self.close()
+
+
+class SharedOverlapIndex:
+    """OverlapIndex on a TermSegment shared by all workers, plus this worker's recent edits.
+
+    Scores are exactly OverlapIndex's. Users edited since the segment was
+    built are kept in a small per-worker overlay of {user_id: Counter} that
+    shadows their rows in the segment, until a newer segment replaces both.
+    The overlay is replaced rather than mutated, so scoring never holds the
+    lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segment = None
+        self._overlay = {}
+
+    @property
+    def segment(self):
+        return self._segment
+
+    @property
+    def overlay_size(self):
+        return len(self._overlay)
+
+    def attach(self, segment):
+        with self._lock:
+            self._segment = segment
+            self._overlay = {}
+
+    def build(self, rows):
+        self.attach(TermSegment.create(rows))
+
+    def update(self, user_id, about):
+        with self._lock:
+            self._overlay = dict(self._overlay)
+            self._overlay[user_id] = Counter(tokenize(about))
+
+    def remove(self, user_id):
+        self.update(user_id, None)
+
+    def match_percentages(self, about, user_ids):
+        """Return {user_id: match percentage} of `about` against each of `user_ids`, as OverlapIndex does."""
+        segment, overlay = self._segment, self._overlay
+        words = Counter(tokenize(about))
+        query = {}
+        if segment is not None:
+            for token, count in words.items():
+                term_id = segment.term_id(token)
+                if term_id is not None:
+                    query[term_id] = count
+        matches = Counter()
+        shared = Counter()
+        if segment is not None and len(user_ids) * 4 < segment.users + len(overlay):
+            for user_id in user_ids:
+                if user_id in overlay:
+                    continue
+                terms, counts = segment.user_terms_of(user_id)
+                for term_id, other_count in zip(terms, counts):
+                    count = query.get(term_id)
+                    if count is not None:
+                        matches[user_id] += min(count, other_count)
+                        shared[user_id] += 1
+        elif segment is not None:
+            for term_id, count in query.items():
+                users, counts = segment.postings(term_id)
+                for user_id, other_count in zip(users.tolist(), counts.tolist()):
+                    matches[user_id] += min(count, other_count)
+                    shared[user_id] += 1
+            for user_id in overlay:
+                matches.pop(user_id, None)
+                shared.pop(user_id, None)
+        for user_id, terms in overlay.items():
+            for token, count in words.items():
+                if token in terms:
+                    matches[user_id] += min(count, terms[token])
+                    shared[user_id] += 1
+        percentages = {}
+        for user_id in user_ids:
+            size = len(overlay[user_id]) if user_id in overlay else segment.size(user_id) if segment is not None else 0
+            total_words = len(words) + size - shared[user_id]
+            percentages[user_id] = (matches[user_id] / total_words) * 100 if total_words > 0 else 0
+        return percentages
+
+    def top_matches(self, about, k, user_ids=None):
+        """Return the k best (user_id, percentage) pairs among `user_ids`, best first and ties by id.
+
+        Without `user_ids` every indexed user competes.
+        """
+        if user_ids is None:
+            segment, overlay = self._segment, self._overlay
+            user_ids = {user_id for user_id in (segment.user_ids() if segment is not None else ()) if user_id not in overlay}
+            user_ids.update(user_id for user_id, terms in overlay.items() if terms)
+            user_ids = list(user_ids)
+        percentages = self.match_percentages(about, user_ids)
+        return heapq.nsmallest(k, percentages.items(), key=lambda item: (-item[1], item[0]))
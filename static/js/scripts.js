@@ -4,4 +4,55 @@
 * Licensed under MIT (https://github.com/StartBootstrap/startbootstrap-one-page-wonder/blob/master/LICENSE)
 */
 // This file is intentionally blank
-// Use this file to add JavaScript to your project
\ No newline at end of file
+// Use this file to add JavaScript to your project
+
+// Keeps appending pages of a cursor-paginated JSON list while the sentinel element is in view.
+// `render` turns one item into a DOM node; the first page is rendered by the server.
+function infiniteList({ container, sentinel, url, cursor, render }) {
+    let next = cursor;
+    let loading = false;
+    if (!next) {
+        sentinel.remove();
+        return;
+    }
+    const observer = new IntersectionObserver(entries => {
+        if (!entries[0].isIntersecting || loading || !next) {
+            return;
+        }
+        loading = true;
+        fetch(`${url}?cursor=${encodeURIComponent(next)}`)
+            .then(response => response.json())
+            .then(page => {
+                page.items.forEach(item => container.appendChild(render(item)));
+                next = page.next_cursor;
+                loading = false;
+                observer.unobserve(sentinel);
+                if (next) {
+                    // Observe again so a sentinel still in view after this page fires once more
+                    observer.observe(sentinel);
+                } else {
+                    sentinel.remove();
+                }
+            });
+    }, { rootMargin: '400px' });
+    observer.observe(sentinel);
+}
+
+// Fills a <template> clone: data-field elements get text, data-src / data-srcset images get URLs
+function fillCard(template, item) {
+    const node = template.content.firstElementChild.cloneNode(true);
+    node.querySelectorAll('[data-field]').forEach(element => {
+        element.textContent = item[element.dataset.field];
+    });
+    node.querySelectorAll('[data-src]').forEach(element => {
+        element.src = item[element.dataset.src] || element.getAttribute('src');
+    });
+    node.querySelectorAll('[data-srcset]').forEach(element => {
+        if (item[element.dataset.srcset]) {
+            element.srcset = item[element.dataset.srcset];
+        } else {
+            element.remove();
+        }
+    });
+    return node;
+}
@@ -0,0 +1,268 @@
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from matching import tokenize, top_scores
+
+MAGIC = b'RLKVEC01'
+HEADER_SIZE = 64
+MIN_CAPACITY = 1024
+TOMBSTONE = -1
+
+
+def hashed_ngram_embedding(text, dim=256, n=3):
+    """Embed text locally by hashing words and their character n-grams into `dim` signed buckets.
+
+    crc32 is used instead of hash() so every process produces the same vectors.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in tokenize(text):
+        padded = '<%s>' % word
+        features = [padded] + [padded[i:i + n] for i in range(max(1, len(padded) - n + 1))]
+        for feature in features:
+            digest = zlib.crc32(feature.encode('utf-8'))
+            vector[digest % dim] += 1.0 if digest & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def text_checksum(text):
+    return zlib.crc32((text or '').encode('utf-8'))
+
+
+class VectorStore:
+    """Fixed-dimension float32 vectors in a memory-mapped file, keyed by user id.
+
+    File layout: a 64 byte header, then `capacity` (user_id, checksum) slots,
+    then `capacity` contiguous vectors. Every process maps the same file, so
+    the vectors live once in the page cache no matter how many workers read
+    them. Rows are only ever appended or tombstoned in place; when the file
+    is full it is rewritten without tombstones under a new inode, which other
+    processes notice and remap.
+    """
+
+    def __init__(self, path, dim):
+        if np is None:
+            raise RuntimeError('The vector store requires numpy')
+        self.path = str(path)
+        self.dim = dim
+        self._id_dtype = np.dtype([('user_id', '<i8'), ('checksum', '<i8')])
+        self._header_dtype = np.dtype([('magic', 'S8'), ('dim', '<u4'), ('reserved', '<u4'),
+                                       ('capacity', '<u8'), ('count', '<u8'), ('generation', '<u8')])
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._inode = None
+        with self._locked():
+            if not os.path.exists(self.path):
+                self._write_file(self.path, np.zeros(0, dtype=self._id_dtype), np.zeros((0, dim), dtype=np.float32), 0)
+            self._refresh()
+        if self._dim_on_disk != dim:
+            raise ValueError('%s holds %d-dimensional vectors, not %d' % (self.path, self._dim_on_disk, dim))
+
+    def __len__(self):
+        with self._thread_lock:
+            self._refresh()
+            return int(np.count_nonzero(self._ids[:self._count()]['user_id'] != TOMBSTONE))
+
+    def checksums(self):
+        """Return {user_id: checksum} for every live row."""
+        with self._thread_lock:
+            self._refresh()
+            ids = self._ids[:self._count()]
+            live = ids[ids['user_id'] != TOMBSTONE]
+            return dict(zip(live['user_id'].tolist(), live['checksum'].tolist()))
+
+    def upsert(self, user_id, vector, checksum=0):
+        with self._locked():
+            self._refresh()
+            self._tombstone(user_id)
+            count = self._count()
+            if count == self._capacity():
+                self._compact(extra=1)
+                count = self._count()
+            self._vectors[count] = vector
+            self._ids[count] = (user_id, checksum)
+            # Publish the row only once it is fully written
+            self._header['count'] = count + 1
+
+    def delete(self, user_id):
+        with self._locked():
+            self._refresh()
+            self._tombstone(user_id)
+
+    def compact(self):
+        with self._locked():
+            self._refresh()
+            self._compact()
+
+    def scores(self, query):
+        """Return (user_ids, similarities) of `query` against every live row."""
+        ids, similarities = self._similarities(np.asarray(query, dtype=np.float32)[:, None])
+        return ids, similarities[:, 0]
+
+    def search(self, queries, k, user_ids=None, floor=None):
+        """Batched top-k: for each query vector, the k most similar (user_id, similarity) pairs.
+
+        With `user_ids` only those users are searched, and any of them without
+        a vector counts as similarity 0. Similarities below `floor` count as
+        `floor`, so those users tie and go by id.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        ids, similarities = self._similarities(queries.T)
+        if floor is not None:
+            similarities = np.maximum(similarities, floor)
+        return [top_scores(ids, column, k, user_ids) for column in similarities.T]
+
+    def _similarities(self, columns):
+        # Multiply straight off the mapping and drop tombstones afterwards, so vectors are never copied
+        with self._thread_lock:
+            self._refresh()
+            count = self._count()
+            ids = self._ids[:count]['user_id']
+            similarities = self._vectors[:count] @ columns
+        live = ids != TOMBSTONE
+        return ids[live], similarities[live]
+
+    def _tombstone(self, user_id):
+        count = self._count()
+        rows = np.nonzero(self._ids[:count]['user_id'] == user_id)[0]
+        self._ids['user_id'][rows] = TOMBSTONE
+
+    def _compact(self, extra=0):
+        count = self._count()
+        ids = self._ids[:count]
+        live = ids['user_id'] != TOMBSTONE
+        capacity = max(MIN_CAPACITY, 2 * (int(live.sum()) + extra))
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        self._write_file(temporary, ids[live], self._vectors[:count][live], capacity, int(self._header['generation'][0]) + 1)
+        os.replace(temporary, self.path)
+        self._refresh()
+
+    def _write_file(self, path, ids, vectors, capacity, generation=0):
+        capacity = max(capacity, MIN_CAPACITY, len(ids))
+        header = np.zeros((), dtype=self._header_dtype)
+        header['magic'] = MAGIC
+        header['dim'] = self.dim
+        header['capacity'] = capacity
+        header['count'] = len(ids)
+        header['generation'] = generation
+        with open(path, 'wb') as f:
+            f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+            f.write(np.ascontiguousarray(ids).tobytes())
+            f.truncate(self._vectors_offset(capacity) + capacity * self.dim * 4)
+            f.seek(self._vectors_offset(capacity))
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _vectors_offset(self, capacity):
+        offset = HEADER_SIZE + capacity * self._id_dtype.itemsize
+        return (offset + 63) // 64 * 64
+
+    def _refresh(self):
+        # Remap when another process has replaced the file
+        inode = os.stat(self.path).st_ino
+        if inode == self._inode:
+            return
+        mapped = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        header = mapped[:self._header_dtype.itemsize].view(self._header_dtype)
+        if header['magic'][0] != MAGIC:
+            raise ValueError('%s is not a vector store' % self.path)
+        capacity = int(header['capacity'][0])
+        self._dim_on_disk = int(header['dim'][0])
+        self._header = header
+        self._ids = np.ndarray((capacity,), dtype=self._id_dtype, buffer=mapped, offset=HEADER_SIZE)
+        self._vectors = np.ndarray((capacity, self._dim_on_disk), dtype=np.float32, buffer=mapped,
+                                   offset=self._vectors_offset(capacity))
+        self._inode = inode
+
+    def _count(self):
+        return int(self._header['count'][0])
+
+    def _capacity(self):
+        return int(self._header['capacity'][0])
+
+    @contextmanager
+    def _locked(self):
+        # Threads serialize on the lock, processes on flock of a sidecar file.
+        # Re-entrant: only the outermost acquisition takes the file lock.
+        with self._thread_lock:
+            if fcntl is None or self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class EmbeddingIndex:
+    """Match index over a VectorStore, scoring profiles by cosine similarity of embeddings.
+
+    `embed` turns an about text into a unit vector of length `dim`; it
+    defaults to hashed character n-grams, which need no model download.
+    """
+
+    def __init__(self, path, dim=256, embed=None):
+        self.embed = embed or (lambda text: hashed_ngram_embedding(text, dim))
+        self.store = VectorStore(path, dim)
+
+    def build(self, rows):
+        # Bring the persisted store in line with the users table, embedding only what changed
+        with self.store._locked():
+            stored = self.store.checksums()
+            seen = set()
+            for row in rows:
+                user_id = row['id']
+                seen.add(user_id)
+                if not tokenize(row['about']):
+                    if user_id in stored:
+                        self.store.delete(user_id)
+                elif stored.get(user_id) != text_checksum(row['about']):
+                    self.update(user_id, row['about'])
+            for user_id in stored.keys() - seen:
+                self.store.delete(user_id)
+
+    def update(self, user_id, about):
+        if not tokenize(about):
+            self.store.delete(user_id)
+            return
+        self.store.upsert(user_id, self.embed(about), text_checksum(about))
+
+    def remove(self, user_id):
+        self.store.delete(user_id)
+
+    def match_percentages(self, about, user_ids):
+        percentages = dict.fromkeys(user_ids, 0.0)
+        if not tokenize(about):
+            return percentages
+        ids, similarities = self.store.scores(self.embed(about))
+        for user_id, similarity in zip(ids.tolist(), similarities.tolist()):
+            if user_id in percentages:
+                percentages[user_id] = max(similarity, 0.0) * 100
+        return percentages
+
+    def top_matches(self, about, k, user_ids=None):
+        if not tokenize(about):
+            return [] if user_ids is None else [(user_id, 0.0) for user_id in sorted(set(user_ids))[:k]]
+        results = self.store.search(self.embed(about), k, user_ids, floor=0.0)[0]
+        return [(user_id, similarity * 100) for user_id, similarity in results]
@@ -0,0 +1,84 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class WriteQueue:
+    """One writer thread running queued writes in shared transactions (group commit).
+
+    submit(func, *args) queues func(conn, *args) and returns a Future for its
+    result. The writer takes whatever has queued up while the previous
+    transaction committed, at most `max_batch` writes, and runs them in a
+    single transaction opened with `begin(conn)`, one savepoint per write: a
+    write that raises is rolled back on its own and its future gets the
+    exception, while the others still commit. Futures resolve only once their
+    transaction has committed.
+    """
+
+    def __init__(self, connect, begin, max_batch=64):
+        self.max_batch = max_batch
+        self._connect = connect
+        self._begin = begin
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.transactions = 0
+        self.writes = 0
+
+    def submit(self, func, *args):
+        future = Future()
+        self._queue.put((func, args, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+                    self._thread.start()
+        return future
+
+    def stats(self):
+        return {
+            'transactions': self.transactions,
+            'writes': self.writes,
+            'queued': self._queue.qsize(),
+            'writes_per_transaction': self.writes / self.transactions if self.transactions else None,
+        }
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(conn, [item for item in batch if item[2].set_running_or_notify_cancel()])
+
+    def _commit(self, conn, batch):
+        outcomes = []
+        try:
+            self._begin(conn)
+            for func, args, future in batch:
+                conn.execute('SAVEPOINT queued_write')
+                try:
+                    result = func(conn, *args)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO queued_write')
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+                conn.execute('RELEASE queued_write')
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.transactions += 1
+        self.writes += len(batch)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)